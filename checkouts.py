@@ -0,0 +1,406 @@
+"""
+Checking out commits of tracked repositories. Each repository is cloned once into a local object store
+(a bare mirror, kept between server restarts when MirrorFolder is set), and commits are checked out from it
+as git worktrees, so checking out another commit doesn't transfer the repository again.
+Checkouts are cached, and the least recently used ones are deleted once the cache is over its budget.
+For huge repositories the store can be a partial clone, with sparse checkouts of only the paths probes use.
+Files can also be read at any commit straight from the store, without a checkout.
+"""
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Disk budget of each repo's checkouts in MB, unless CheckoutCacheSize is set...
+DEFAULT_CHECKOUT_CACHE_SIZE = 2048
+# ...and the most checkouts kept, unless CheckoutCacheEntries is set
+DEFAULT_CHECKOUT_CACHE_ENTRIES = 16
+
+
+def git(args, cwd, quiet=False):
+    """
+    Run a git command
+    :param quiet: hide the command's error output
+    :return: the command's output, without the trailing newline
+    """
+    stderr = subprocess.DEVNULL if quiet else None
+    return subprocess.check_output(['git'] + args, cwd=cwd, stderr=stderr).decode('utf-8').strip()
+
+
+def directory_size(path):
+    """
+    Get the size of the files under path in bytes
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class Checkout:
+    """
+    A commit checked out into a worktree of a CheckoutManager's object store.
+    Like a TemporaryDirectory, name is the directory the commit was checked out into
+    """
+    def __init__(self, manager, name, commit):
+        self.manager = manager
+        self.name = name
+        self.commit = commit
+        # Number of users that need the checkout to stay around. Pinned checkouts are never evicted
+        self.pins = 0
+        self.size = directory_size(name)
+
+    def cleanup(self):
+        self.manager.remove(self)
+
+    def __repr__(self):
+        return "<Checkout {} at {}>".format(self.commit, self.name)
+
+
+class ObjectReader:
+    """
+    A long-lived git cat-file --batch process, for reading files at any commit without checking it out
+    """
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.process = None
+
+    def read(self, commit, path):
+        """
+        Read a file at a commit, e.g. read('HEAD', 'version.txt')
+        :return: the file's contents as bytes, or None if there is no such file
+        """
+        if '\n' in commit or '\n' in path:
+            return None
+        self.lock.acquire()
+        try:
+            if self.process is None or self.process.poll() is not None:
+                self.process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=self.store,
+                                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.process.stdin.write((commit + ':' + path + '\n').encode('utf-8'))
+            self.process.stdin.flush()
+            # "<hash> <type> <size>", or "<name> missing" if there is no such object
+            header = self.process.stdout.readline().decode('utf-8')
+            if header.endswith(' missing\n') or header.endswith(' ambiguous\n'):
+                return None
+            object_hash, object_type, size = header.split()
+            contents = self.process.stdout.read(int(size))
+            self.process.stdout.read(1)
+            if object_type != 'blob':
+                return None
+            return contents
+        except (OSError, ValueError):
+            # The process died or got out of step, so start a new one next time
+            self.close()
+            raise
+        finally:
+            self.lock.release()
+
+    def close(self):
+        # Callers hold self.lock, or know nothing else uses the reader
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+class CheckoutManager:
+    """
+    Keeps a local object store for one repository, and checks its commits out as worktrees
+    """
+    def __init__(self, url, mirror=None, max_size=DEFAULT_CHECKOUT_CACHE_SIZE,
+                 max_entries=DEFAULT_CHECKOUT_CACHE_ENTRIES, folder=None, sparse_paths=None):
+        """
+        :param mirror: where to keep a persistent bare mirror of the repository. Without it, the repository
+        is cloned into a temp directory that only lasts as long as the manager
+        :param max_size: disk budget for the checkouts in MB
+        :param folder: where to put checkouts, e.g. a tmpfs. Defaults to the system temp directory
+        :param sparse_paths: function giving the paths to check out of a commit, as sparse-checkout patterns,
+        or None to check out everything. When set, the store is a partial clone (--filter=blob:none).
+        Files outside of the sparse checkouts aren't in the worktrees at all. Only reads through git, like
+        {HEAD:path} or git show, fetch their blobs from the remote
+        """
+        self.url = url
+        self.mirror = mirror
+        self.sparse_paths = sparse_paths
+        self.max_size = max_size * 1024 * 1024
+        self.max_entries = max_entries
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.store_dir = None
+        self.store = None
+        self.reader = None
+        # Cached checkouts by commit hash, least recently used first
+        self.checkouts = OrderedDict()
+        # Futures of the checkouts being created, so a commit is only checked out once at a time
+        self.loading = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        managers.add(self)
+
+    def get_store(self):
+        """
+        Get the path of the object store, cloning the repository the first time.
+        A mirror left by an earlier run is fetched instead
+        """
+        self.lock.acquire()
+        try:
+            if self.store is None or not os.path.isdir(self.store):
+                if self.mirror is None:
+                    self.store_dir = tempfile.TemporaryDirectory()
+                    self.store = os.path.join(self.store_dir.name, 'objects.git')
+                else:
+                    self.store = os.path.abspath(self.mirror)
+                if os.path.isdir(self.store):
+                    print("Fetching " + self.url + " into " + self.store + "...\n")
+                    # Worktrees of the earlier run were in temp directories that may be gone
+                    git(['worktree', 'prune'], self.store)
+                    remove_stale_worktrees(self.store)
+                    git(['fetch', '--quiet', '--prune', 'origin'], self.store)
+                else:
+                    print("Cloning " + self.url + "...\n")
+                    os.makedirs(os.path.dirname(self.store), exist_ok=True)
+                    args = ['clone', '--mirror', '--quiet']
+                    if self.sparse_paths is not None:
+                        args.append('--filter=blob:none')
+                    git(args + [self.url, self.store], os.path.dirname(self.store))
+            return self.store
+        finally:
+            self.lock.release()
+
+    def fetch(self):
+        """
+        Bring the object store up to date with the repository
+        """
+        store = self.get_store()
+        git(['fetch', '--quiet', '--prune', 'origin'], store)
+
+    def rev_parse(self, commit_name):
+        """
+        Resolve a commit name (hash, branch, tag, HEAD~1...) to its hash
+        """
+        if commit_name == 'current':
+            commit_name = 'HEAD'
+        return git(['rev-parse', '--verify', '--quiet', commit_name + '^{commit}'], self.get_store(), True)
+
+    def list_files(self, commit, folder):
+        """
+        List the files under folder at a commit, without checking it out
+        """
+        output = git(['ls-tree', '-r', '-z', '--name-only', commit, '--', folder], self.get_store())
+        return [path for path in output.split('\0') if path]
+
+    def read_file(self, commit, path):
+        """
+        Read a file at a commit, without checking it out
+        :return: the file's contents as bytes, or None if there is no such file
+        """
+        store = self.get_store()
+        self.lock.acquire()
+        old_reader = None
+        if self.reader is None or self.reader.store != store:
+            old_reader, self.reader = self.reader, ObjectReader(store)
+        reader = self.reader
+        self.lock.release()
+        if old_reader is not None:
+            close_reader(old_reader)
+        return reader.read(commit, path)
+
+    def close(self):
+        """
+        Stop the git process reading files from the store and delete every cached checkout, e.g. before the server
+        restarts. Checkouts in use are deleted too, so this is only for when no probe is running.
+        A later read or checkout starts over
+        """
+        self.lock.acquire()
+        reader, self.reader = self.reader, None
+        checkouts = list(self.checkouts.values())
+        self.checkouts.clear()
+        self.size = 0
+        self.lock.release()
+        if reader is not None:
+            close_reader(reader)
+        for checkout in checkouts:
+            self.remove(checkout)
+
+    def checkout(self, commit, pin=False):
+        """
+        Get a checkout of a commit, checking it out into a new temp directory if it isn't cached
+        :param pin: keep the checkout from being evicted until it is passed to unpin()
+        :return: the Checkout
+        """
+        store = self.get_store()
+        commit = self.rev_parse(commit)
+        self.lock.acquire()
+        checkout = self.checkouts.get(commit)
+        if checkout is not None and not os.path.isdir(checkout.name):
+            # Deleted from under the cache
+            del self.checkouts[commit]
+            self.size -= checkout.size
+            checkout = None
+        if checkout is not None:
+            self.hits += 1
+            self.checkouts.move_to_end(commit)
+            if pin:
+                checkout.pins += 1
+            self.lock.release()
+            return checkout
+        future = self.loading.get(commit)
+        if future is not None:
+            self.hits += 1
+            self.lock.release()
+            checkout = future.result()
+            if pin:
+                self.pin(checkout)
+            return checkout
+        self.misses += 1
+        future = Future()
+        self.loading[commit] = future
+        self.lock.release()
+
+        try:
+            if self.folder is not None:
+                os.makedirs(self.folder, exist_ok=True)
+            path = tempfile.mkdtemp(prefix='saad-' + commit[:12] + '-', dir=self.folder)
+            print("Checking out commit " + commit + "...\n")
+            patterns = None
+            if self.sparse_paths is not None:
+                patterns = self.sparse_paths(commit)
+            if patterns is None:
+                git(['worktree', 'add', '--detach', '--quiet', path, commit], store)
+            else:
+                git(['worktree', 'add', '--detach', '--quiet', '--no-checkout', path, commit], store)
+                git(['sparse-checkout', 'set', '--no-cone'] + patterns, path)
+                git(['-c', 'advice.detachedHead=false', 'checkout', '--quiet', '--detach', commit], path)
+            checkout = Checkout(self, path, commit)
+        except BaseException as e:
+            self.lock.acquire()
+            del self.loading[commit]
+            self.lock.release()
+            future.set_exception(e)
+            raise
+        self.lock.acquire()
+        del self.loading[commit]
+        self.checkouts[commit] = checkout
+        self.size += checkout.size
+        if pin:
+            checkout.pins += 1
+        evicted = self.__evict__(checkout)
+        self.lock.release()
+        future.set_result(checkout)
+        for old in evicted:
+            self.remove(old)
+        return checkout
+
+    def pin(self, checkout):
+        self.lock.acquire()
+        checkout.pins += 1
+        self.lock.release()
+
+    def unpin(self, checkout):
+        """
+        Let a checkout be evicted again, once nothing else has it pinned
+        """
+        self.lock.acquire()
+        checkout.pins -= 1
+        evicted = self.__evict__()
+        self.lock.release()
+        for old in evicted:
+            self.remove(old)
+
+    def __evict__(self, keep=None):
+        """
+        Drop the least recently used unpinned checkouts until the cache is within its budget.
+        Callers hold self.lock, and delete the returned checkouts after releasing it
+        :param keep: a checkout that is about to be returned, and mustn't be evicted yet
+        :return: the evicted checkouts
+        """
+        evicted = []
+        for commit, checkout in list(self.checkouts.items()):
+            if self.size <= self.max_size and len(self.checkouts) <= self.max_entries:
+                break
+            if checkout.pins > 0 or checkout is keep:
+                continue
+            del self.checkouts[commit]
+            self.size -= checkout.size
+            self.evictions += 1
+            evicted.append(checkout)
+        if self.size > self.max_size or len(self.checkouts) > self.max_entries:
+            logging.debug("Checkout cache of %s is over budget, but the rest of its checkouts are in use", self.url)
+        return evicted
+
+    def stats(self):
+        self.lock.acquire()
+        stats = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                 'entries': len(self.checkouts), 'size': self.size,
+                 'pinned': len([checkout for checkout in self.checkouts.values() if checkout.pins > 0])}
+        self.lock.release()
+        return stats
+
+    def remove(self, checkout):
+        """
+        Delete a checkout's worktree
+        """
+        try:
+            git(['worktree', 'remove', '--force', checkout.name], self.get_store(), True)
+        except subprocess.CalledProcessError:
+            logging.debug("Worktree %s was already removed", checkout.name)
+            shutil.rmtree(checkout.name, ignore_errors=True)
+            git(['worktree', 'prune'], self.get_store())
+
+
+def remove_stale_worktrees(store):
+    """
+    Delete the checkouts a store still has from an earlier run that didn't get to clean up, e.g. after a crash.
+    They are the worktrees in saad-* temp directories
+    """
+    output = git(['worktree', 'list', '--porcelain'], store)
+    for line in output.splitlines():
+        if not line.startswith('worktree '):
+            continue
+        path = line[len('worktree '):]
+        if os.path.basename(path).startswith('saad-') and os.path.abspath(path) != os.path.abspath(store):
+            logging.info("Removing checkout %s left by an earlier run", path)
+            try:
+                git(['worktree', 'remove', '--force', path], store, True)
+            except subprocess.CalledProcessError:
+                shutil.rmtree(path, ignore_errors=True)
+    git(['worktree', 'prune'], store)
+
+
+def close_reader(reader):
+    # Waits for a read in progress to finish first
+    reader.lock.acquire()
+    try:
+        reader.close()
+    finally:
+        reader.lock.release()
+
+
+# Every checkout manager that is still in use, so they can all be closed together
+managers = weakref.WeakSet()
+
+
+def close_managers():
+    for manager in list(managers):
+        manager.close()
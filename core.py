@@ -1,6 +1,11 @@
+import asyncio
+import fnmatch
+import hashlib
+import itertools
 import json
 import logging
 import os
+import queue
 import re
 import shlex
 import subprocess
@@ -12,9 +17,38 @@ import sqlite3
 import tempfile
 import configparser
 
+from concurrent.futures import Future
 from concurrent.futures.thread import ThreadPoolExecutor
 from pathlib import Path
 
+from probelog import ProbeLogger, migrate_database, DEFAULT_COMPACT_INTERVAL
+from checkouts import CheckoutManager, DEFAULT_CHECKOUT_CACHE_SIZE, DEFAULT_CHECKOUT_CACHE_ENTRIES
+from workers import WorkerPool, call_module, DEFAULT_WORKER_PROCESSES, DEFAULT_WORKER_MAX_JOBS, \
+    DEFAULT_WORKER_MAX_MEMORY
+
+# Size of the worker pool used when neither the server nor the repo config sets ProbeWorkers
+DEFAULT_PROBE_WORKERS = 8
+# Probes the asyncio engine (ProbeEngine = asyncio) runs at once, unless AsyncProbeLimit is set
+DEFAULT_ASYNC_PROBE_LIMIT = 1000
+# Budgets of the probe result cache (ResultCacheSize in MB, ResultCacheEntries) when it is enabled
+DEFAULT_RESULT_CACHE_SIZE = 256
+DEFAULT_RESULT_CACHE_ENTRIES = 100000
+# KB of each probe's output kept in memory, unless OutputMemoryLimit is set. Longer output is spilled to a file
+DEFAULT_OUTPUT_MEMORY_LIMIT = 1024
+# Bytes read from a probe's output at a time
+OUTPUT_CHUNK_SIZE = 65536
+# Matches {name} placeholders. Probes in a shared scope are referenced as {file.name},
+# and files at a commit as {HEAD:path/to/file}
+NAMED_VALUE_REGEX = r'{([a-zA-Z0-9_~.]+(?::[^{}\s\'"]+)?)}'
+# Inputs that configure how a probe runs rather than being passed on to its module
+PROBE_CONTROL_INPUTS = ('condition', 'timeout')
+# Placeholders ending with this, like {diff:file}, are filled in with the path of a file holding the value
+FILE_SUFFIX = ':file'
+# Matches paths in a checkout, like {HEAD}/version.txt. Used to find the paths sparse checkouts need
+CHECKOUT_PATH_REGEX = r'{HEAD(?:~1)?}/([^\s\'";&|<>()]+)'
+# Matches a checkout used without a path, like cd {HEAD}, which could read anything in it
+CHECKOUT_ROOT_REGEX = r'{HEAD(?:~1)?}(?!/[^\s\'";&|<>()])'
+
 
 def split_config_list(string):
     return [i.strip() for i in string.split(";")]
@@ -36,28 +70,312 @@ def insert_named_values(string, values):
     -> "Hello Bob"
     Variables with no corresponding value are left as is (i.e. "{variable}")
     """
-    return re.sub(r'{([a-zA-Z0-9_~]+)}', lambda m: swap_named_value(m, values), str(string))
+    return compile_template(string).render(values)
 
 
 def get_named_values(string):
-    output = []
-    for match in re.finditer(r'{([a-zA-Z0-9_~]+)}', str(string)):
-        output.append(match.group(1))
-    return output
+    return list(compile_template(string).names)
 
 
-def swap_named_value(match, values):
+class Template:
     """
-    Replace regex matches with variables.
-    :param match: regex match group
-    :param values: values dictionary
-    :return: String to use in place of the variable
+    A string with {name} placeholders, split once into literal text and placeholder names,
+    so rendering it is a join instead of a regex substitution
     """
-    if match.group(1) in values:
-        return str(values.get(match.group(1)))
-    else:
-        logging.debug("Leaving variable as-is because it has no matching value: %s", match.group(0))
-        return match.group(0)
+    def __init__(self, source):
+        self.source = source
+        # Literal text at even indices, placeholder names at odd ones
+        self.segments = []
+        last = 0
+        for match in re.finditer(NAMED_VALUE_REGEX, source):
+            self.segments.append(source[last:match.start()])
+            self.segments.append(match.group(1))
+            last = match.end()
+        self.segments.append(source[last:])
+        self.names = tuple(self.segments[1::2])
+        # The name, if the template is nothing but one placeholder
+        self.placeholder = None
+        if len(self.names) == 1 and self.segments[0] == '' and self.segments[2] == '':
+            self.placeholder = self.names[0]
+
+    def render(self, values):
+        """
+        Fill in the placeholders. Ones with no value are left as is (i.e. "{variable}")
+        """
+        if not self.names:
+            return self.source
+        parts = self.segments.copy()
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            if name in values:
+                parts[i] = str(values[name])
+            else:
+                parts[i] = "{" + name + "}"
+        return "".join(parts)
+
+
+# Compiled templates by source. Module commands and probe inputs are compiled once and then reused
+templates = {}
+templates_lock = threading.Lock()
+MAX_COMPILED_TEMPLATES = 10000
+
+
+def compile_template(string):
+    """
+    Get the compiled Template for a string
+    """
+    string = str(string)
+    template = templates.get(string)
+    if template is None:
+        template = Template(string)
+        templates_lock.acquire()
+        if len(templates) >= MAX_COMPILED_TEMPLATES:
+            templates.clear()
+        templates[string] = template
+        templates_lock.release()
+    return template
+
+
+# Tokens of probe conditions: placeholders, quoted strings, numbers, operators and words
+CONDITION_TOKEN_REGEX = re.compile(r'\s*(?:(?P<placeholder>' + NAMED_VALUE_REGEX + r')'
+                                   r'|(?P<string>\'(?:[^\'\\]|\\.)*\'|"(?:[^"\\]|\\.)*")'
+                                   r'|(?P<number>-?[0-9]+(?:\.[0-9]+)?)'
+                                   r'|(?P<operator>==|!=|<=|>=|<|>|\(|\)|,)'
+                                   r'|(?P<word>[A-Za-z_]+))')
+# Functions conditions can call on a value
+CONDITION_FUNCTIONS = {
+    'empty': lambda value: condition_text(value) == '',
+    'number': lambda value: condition_number(value),
+    'length': lambda value: len(condition_text(value)),
+}
+
+
+def condition_text(value):
+    """
+    Get a value as text for conditions. Probe outputs usually end with a newline, so whitespace around it is ignored.
+    Output that was spilled to a file is read back, so conditions see all of it rather than the file's path
+    """
+    if value is None:
+        return ''
+    if isinstance(value, OutputFile):
+        with open(value, encoding='utf-8', errors='replace') as file:
+            return file.read().strip()
+    return str(value).strip()
+
+
+def condition_number(value):
+    """
+    Parse a value as a number for conditions
+    :return: None if it isn't a number
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        number = float(condition_text(value))
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else number
+
+
+def condition_truth(value):
+    """
+    Whether a value counts as true in a condition. Text like "True\n" printed by a probe is parsed,
+    so are numbers, and empty text and missing values are false
+    """
+    if value is None or isinstance(value, bool):
+        return bool(value)
+    text = condition_text(value)
+    if text.lower() in ('true', 'false', 'none', ''):
+        return text.lower() == 'true'
+    number = condition_number(text)
+    if number is not None:
+        return number != 0
+    return True
+
+
+def condition_compare(operator, left, right):
+    if operator == 'contains':
+        return condition_text(right) in condition_text(left)
+    if operator in ('==', '!='):
+        if isinstance(left, bool) or isinstance(right, bool):
+            equal = condition_truth(left) == condition_truth(right)
+        else:
+            left_number, right_number = condition_number(left), condition_number(right)
+            if left_number is not None and right_number is not None:
+                equal = left_number == right_number
+            else:
+                equal = condition_text(left) == condition_text(right)
+        return equal if operator == '==' else not equal
+    # Ordering only makes sense for numbers, so text like an error message never counts as big or small
+    left, right = condition_number(left), condition_number(right)
+    if left is None or right is None:
+        return False
+    if operator == '<':
+        return left < right
+    if operator == '<=':
+        return left <= right
+    if operator == '>':
+        return left > right
+    return left >= right
+
+
+class Condition:
+    """
+    A probe condition, parsed once into a tree of functions and evaluated with the bindings as values,
+    so probe output is never parsed as code. Supports {placeholders}, 'strings' (which can contain placeholders),
+    numbers, True and False, ==, !=, <, <=, >, >=, contains, and, or, not, parentheses,
+    and the functions empty(), number() and length()
+    Example: Condition("{versionBump} and not empty({newVersion})")
+    """
+    def __init__(self, source):
+        self.source = source
+        self.tokens = []
+        position = 0
+        source = source.rstrip()
+        while position < len(source):
+            match = CONDITION_TOKEN_REGEX.match(source, position)
+            if match is None or match.end() == position:
+                raise ValueError("Invalid condition {!r} at {!r}".format(self.source, source[position:]))
+            kind = match.lastgroup
+            if kind not in ('placeholder', 'string', 'number', 'operator', 'word'):
+                # The placeholder's own group matched
+                kind = 'placeholder'
+            self.tokens.append((kind, match.group(kind)))
+            position = match.end()
+        self.position = 0
+        # Placeholders the condition uses
+        self.names = set()
+        self.evaluate_tree = self.__parse_or__()
+        if self.position < len(self.tokens):
+            raise ValueError("Invalid condition {!r}: unexpected {!r}".format(self.source,
+                                                                            self.tokens[self.position][1]))
+        del self.tokens
+
+    def evaluate(self, values):
+        """
+        :param values: the bindings the condition's placeholders refer to
+        """
+        return condition_truth(self.evaluate_tree(values))
+
+    def __peek__(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def __next__(self):
+        token = self.__peek__()
+        if token[0] is None:
+            raise ValueError("Invalid condition {!r}: it ends too soon".format(self.source))
+        self.position += 1
+        return token
+
+    def __is_word__(self, word):
+        kind, value = self.__peek__()
+        return kind == 'word' and value.lower() == word
+
+    def __parse_or__(self):
+        left = self.__parse_and__()
+        while self.__is_word__('or'):
+            self.__next__()
+            right = self.__parse_and__()
+            left = (lambda left, right: lambda values: condition_truth(left(values)) or
+                    condition_truth(right(values)))(left, right)
+        return left
+
+    def __parse_and__(self):
+        left = self.__parse_not__()
+        while self.__is_word__('and'):
+            self.__next__()
+            right = self.__parse_not__()
+            left = (lambda left, right: lambda values: condition_truth(left(values)) and
+                    condition_truth(right(values)))(left, right)
+        return left
+
+    def __parse_not__(self):
+        if self.__is_word__('not'):
+            self.__next__()
+            operand = self.__parse_not__()
+            return lambda values: not condition_truth(operand(values))
+        return self.__parse_comparison__()
+
+    def __parse_comparison__(self):
+        left = self.__parse_operand__()
+        kind, operator = self.__peek__()
+        if kind == 'word' and operator.lower() == 'contains':
+            operator = 'contains'
+        elif kind != 'operator' or operator not in ('==', '!=', '<', '<=', '>', '>='):
+            return left
+        self.__next__()
+        right = self.__parse_operand__()
+        return lambda values: condition_compare(operator, left(values), right(values))
+
+    def __parse_operand__(self):
+        kind, value = self.__next__()
+        if kind == 'placeholder':
+            name = value[1:-1]
+            self.names.add(name)
+            return lambda values: values.get(name)
+        if kind == 'string':
+            template = compile_template(re.sub(r'\\(.)', r'\1', value[1:-1]))
+            self.names.update(template.names)
+            return lambda values: template.render(values)
+        if kind == 'number':
+            number = condition_number(value)
+            return lambda values: number
+        if kind == 'operator' and value == '(':
+            inner = self.__parse_or__()
+            self.__expect__(')')
+            return inner
+        if kind == 'word':
+            word = value.lower()
+            if word in ('true', 'false', 'none'):
+                constant = {'true': True, 'false': False, 'none': None}[word]
+                return lambda values: constant
+            if word in CONDITION_FUNCTIONS and self.__peek__() == ('operator', '('):
+                self.__next__()
+                argument = self.__parse_or__()
+                self.__expect__(')')
+                function = CONDITION_FUNCTIONS[word]
+                return lambda values: function(argument(values))
+        raise ValueError("Invalid condition {!r}: unexpected {!r}".format(self.source, value))
+
+    def __expect__(self, operator):
+        if self.__next__() != ('operator', operator):
+            raise ValueError("Invalid condition {!r}: expected {!r}".format(self.source, operator))
+
+
+# Parsed conditions by source, so each probe definition's condition is only parsed once
+conditions = {}
+
+
+def compile_condition(source):
+    source = str(source)
+    condition = conditions.get(source)
+    if condition is None:
+        condition = Condition(source)
+        templates_lock.acquire()
+        if len(conditions) >= MAX_COMPILED_TEMPLATES:
+            conditions.clear()
+        conditions[source] = condition
+        templates_lock.release()
+    return condition
+
+
+def check_probe_configs(configs):
+    """
+    Check the probes of a probe file before any of them is created, so a file with a bad probe is left out whole
+    :raises ValueError: if two probes have the same name, or a probe's condition doesn't parse
+    """
+    names = set()
+    for probe_config in configs:
+        if 'name' in probe_config:
+            if probe_config['name'] in names:
+                raise ValueError("Duplicate probe name " + probe_config['name'])
+            names.add(probe_config['name'])
+        if 'condition' in probe_config.get('config', {}):
+            compile_condition(probe_config['config']['condition'])
 
 
 def merge_two_dicts(x, y):
@@ -84,10 +402,56 @@ def all_json_in_dir(dir_path):
     """
     # Search recursively in order to allow user to decide
     # their preferred method of organization
+    for path, parsed in all_json_files_in_dir(dir_path):
+        yield parsed
+
+
+def probe_paths(probe_config, module):
+    """
+    Find the paths a probe reads from its checkouts, by filling its inputs into its module's templates.
+    Paths that depend on other probes' results, like {HEAD}/{file} with a {file} probe, become their folder
+    :return: sparse-checkout patterns, or None if the probe could read anything in the checkout, because it uses
+    a checkout without a path like {HEAD}, or a path that is only known once another probe has run
+    """
+    inputs = {k: str(v) for k, v in probe_config.get('config', {}).items()}
+    templates = [module.config.get('command', '')] + list(module.config.get('kwargs', {}).values())
+    templates += inputs.values()
+    patterns = []
+    for template in templates:
+        template = insert_named_values(template, inputs)
+        if re.search(CHECKOUT_ROOT_REGEX, template):
+            return None
+        for path in re.findall(CHECKOUT_PATH_REGEX, template):
+            if '{' in path:
+                path = path[:path.index('{')]
+                if '/' not in path:
+                    return None
+                path = path[:path.rindex('/') + 1]
+            patterns.append("/" + path)
+    paths = probe_config.get('paths', [])
+    if isinstance(paths, str):
+        paths = [paths]
+    patterns.extend("/" + path for path in paths)
+    return patterns
+
+
+def probe_file_namespace(dir_path, file_path):
+    """
+    Get the namespace of a probe file in a shared scope: its path relative to the probe folder,
+    without the extension and with dots between folders. E.g. slack/updates.json -> slack.updates
+    """
+    relative = os.path.splitext(os.path.relpath(file_path, dir_path))[0]
+    return ".".join(Path(relative).parts)
+
+
+def all_json_files_in_dir(dir_path):
+    """
+    Like all_json_in_dir, but yields (path, parsed json) pairs
+    """
     pathlist = Path(dir_path).glob("**/*.json")
     for path in pathlist:
         parsed = parse_json_file(str(path))
-        yield parsed
+        yield str(path), parsed
 
 def connect_database(path):
     """
@@ -125,36 +489,735 @@ def init_user_database(db):
 
 def init_database(db):
     """
-    Initialize an sqlite database to keep track of probes that have run, if one doesn't exist
+    Initialize an sqlite database to keep track of probes that have run, or migrate an older one
     """
-    cursor = db.cursor()
-    tables_schema = {}
-    tables_schema[
-        'probes'] = 'CREATE TABLE probes(id INTEGER, type TEXT, name TEXT, create_time INTEGER, start_time INTEGER, end_time INTEGER, PRIMARY KEY(id ASC));'
-    tables_schema['probe_inputs'] = 'CREATE TABLE probe_inputs(probe_id INTEGER, name TEXT, value TEXT);'
-    tables_schema['probe_outputs'] = 'CREATE TABLE probe_outputs(probe_id INTEGER, errors TEXT, output TEXT);'
-    for table_name in ['probes', 'probe_inputs', 'probe_outputs']:
-        print("Checking table " + table_name)
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (table_name,))
-        res = cursor.fetchone()
-        if res is None:
-            print("Adding table " + table_name)
-            cursor.execute(tables_schema[table_name])
-            db.commit()
+    migrate_database(db)
     db.close()
 
 
+def configure_probe_logger(repo):
+    """
+    Apply the probe log settings of a repo's config (usually the server's): ProbeLogCompression, and the retention
+    settings ProbeLogMaxAge (days), ProbeLogMaxRowsPerModule and ProbeLogMaxSize (MB)
+    """
+    def number(key):
+        value = repo.get_server_setting(key)
+        return int(value) if value is not None else None
+
+    probe_logger.configure(repo.get_server_setting('probelogcompression', 'zlib'), number('probelogmaxage'),
+                           number('probelogmaxrowspermodule'), number('probelogmaxsize'),
+                           int(repo.get_server_setting('probelogcompactinterval', DEFAULT_COMPACT_INTERVAL)))
+
+
+def git_blob_hash(path):
+    """
+    Hash a file the same way git hashes blobs, without needing git or a repository
+    """
+    digest = hashlib.sha1()
+    digest.update(b"blob " + str(os.path.getsize(path)).encode() + b"\0")
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def path_content_hash(path, cwd, checkouts):
+    """
+    Get a hash identifying the content at path: the blob hash of a file, or for a directory in one of the
+    checkouts the hash of its tree object. Nothing else writes to those checkouts, so the tree matches what is on disk
+    :param checkouts: the folders of the checkouts made by the repo's checkout manager
+    :return: None if path is a directory outside of those checkouts, False if it doesn't exist
+    """
+    path = os.path.join(cwd, path)
+    if os.path.isfile(path):
+        return git_blob_hash(path)
+    if not os.path.isdir(path):
+        return False
+    path = os.path.realpath(path)
+    for checkout in checkouts:
+        checkout = os.path.realpath(checkout)
+        if path != checkout and not path.startswith(checkout + os.sep):
+            continue
+        tree = 'HEAD:' + os.path.relpath(path, checkout).replace(os.sep, '/') if path != checkout else 'HEAD:'
+        try:
+            return subprocess.check_output(['git', 'rev-parse', tree], cwd=checkout,
+                                           stderr=subprocess.DEVNULL).decode('utf-8').strip()
+        except (subprocess.CalledProcessError, OSError):
+            return None
+    return None
+
+
+class ResultCache:
+    """
+    Persistent cache of probe results, so rerunning a probe on unchanged content returns instantly.
+    Results are keyed by the module, the populated command and the content hashes of every path it mentions,
+    and the least recently used results are evicted once the cache is over its size or entry budget.
+    Nothing else is in the key, so commands reading the time, the network or random numbers have to opt out
+    """
+    def __init__(self, path, max_size=DEFAULT_RESULT_CACHE_SIZE, max_entries=DEFAULT_RESULT_CACHE_ENTRIES):
+        """
+        :param max_size: budget for the stored outputs in MB
+        """
+        self.lock = threading.Lock()
+        self.max_size = max_size * 1024 * 1024
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results(key TEXT, output BLOB, errors BLOB, size INTEGER, '
+                        'last_used REAL, PRIMARY KEY(key));')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results(last_used);')
+        self.db.commit()
+        self.size, self.entries = self.db.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM results;').fetchone()
+
+    def get_key(self, module, invocation, cwd, checkouts):
+        """
+        Get the cache key for running module with invocation (a populated command, or the keyword arguments of a
+        callable module) in cwd
+        :param checkouts: the commit bindings checked out by the checkout manager, e.g. {'HEAD': temp dir}.
+        Their temp dirs change between runs, so they are replaced with their names and the content hashes
+        tell the commits apart
+        :return: None if the result can't be cached, because it depends on a directory outside of those checkouts,
+        or it mentions no path at all and so may depend on anything
+        """
+        def normalize(string):
+            for name, path in sorted(checkouts.items(), key=lambda item: -len(item[1])):
+                string = string.replace(path, "{" + name + "}")
+            return string
+
+        if isinstance(invocation, dict):
+            words = [str(value) for value in invocation.values()]
+            invocation = json.dumps(invocation, sort_keys=True)
+        else:
+            try:
+                words = shlex.split(invocation)
+            except ValueError:
+                words = invocation.split()
+        hashes = []
+        for word in words:
+            content_hash = path_content_hash(word, cwd, checkouts.values())
+            if content_hash is None:
+                return None
+            if content_hash:
+                hashes.append([normalize(word), content_hash])
+        if not hashes:
+            return None
+        key = json.dumps([module.name, module.config, cwd, normalize(invocation), hashes], sort_keys=True)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :return: the cached (output, errors), or None
+        """
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT output, errors FROM results WHERE key=?;', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE results SET last_used=? WHERE key=?;', (time.time(), key))
+            self.db.commit()
+            return bytes(row[0]), bytes(row[1])
+        finally:
+            self.lock.release()
+
+    def put(self, key, output, errors):
+        size = len(output) + len(errors)
+        if size > self.max_size:
+            return
+        self.lock.acquire()
+        try:
+            old = self.db.execute('SELECT size FROM results WHERE key=?;', (key,)).fetchone()
+            if old is not None:
+                self.size -= old[0]
+                self.entries -= 1
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?);',
+                            (key, output, errors, size, time.time()))
+            self.size += size
+            self.entries += 1
+            self.__evict__()
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def __evict__(self):
+        # Callers hold self.lock
+        if self.size <= self.max_size and self.entries <= self.max_entries:
+            return
+        evicted = []
+        cursor = self.db.execute('SELECT key, size FROM results ORDER BY last_used ASC;')
+        for key, size in cursor:
+            if self.size <= self.max_size and self.entries <= self.max_entries:
+                break
+            evicted.append((key,))
+            self.size -= size
+            self.entries -= 1
+        cursor.close()
+        self.db.executemany('DELETE FROM results WHERE key=?;', evicted)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': self.entries, 'size': self.size}
+
+
+class OutputBuffer:
+    """
+    Collects one output stream of a probe as it is read. Only the first limit bytes are kept in memory.
+    Once the output grows past that, all of it is written to a temp file instead, when spill is set
+    """
+    def __init__(self, limit=DEFAULT_OUTPUT_MEMORY_LIMIT * 1024, folder=None, spill=True):
+        """
+        :param folder: where to put spilled output. Defaults to the system temp directory
+        """
+        self.limit = limit
+        self.folder = folder
+        self.spill = spill
+        self.head = bytearray()
+        # Size of the whole output in bytes
+        self.size = 0
+        self.file = None
+        # Path of the file with the whole output, if it was spilled
+        self.path = None
+
+    def write(self, data):
+        if not data:
+            return
+        if self.file is None and self.spill and self.size + len(data) > self.limit:
+            if self.folder is not None:
+                os.makedirs(self.folder, exist_ok=True)
+            self.file = tempfile.NamedTemporaryFile(prefix='saad-output-', dir=self.folder, delete=False)
+            self.path = self.file.name
+            self.file.write(self.head)
+        if self.file is not None:
+            self.file.write(data)
+        if len(self.head) < self.limit:
+            self.head += data[:self.limit - len(self.head)]
+        self.size += len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def getvalue(self):
+        """
+        :return: the output kept in memory as bytes, ending with a marker if the output was longer
+        """
+        if self.size <= self.limit:
+            return bytes(self.head)
+        marker = "\n[output truncated, {} bytes in total".format(self.size)
+        if self.path is not None:
+            marker += ", full output in " + self.path
+        return bytes(self.head) + (marker + "]\n").encode('utf-8')
+
+
+def read_output(stream, buffer):
+    """
+    Read a probe's output stream into an OutputBuffer until it closes
+    """
+    for chunk in iter(lambda: stream.read1(OUTPUT_CHUNK_SIZE), b''):
+        buffer.write(chunk)
+    stream.close()
+
+
+async def read_output_async(stream, buffer):
+    """
+    Like read_output, for the streams of an asyncio subprocess
+    """
+    while True:
+        chunk = await stream.read(OUTPUT_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer.write(chunk)
+
+
+class OutputFile(str):
+    """
+    The path of a probe's output that was spilled to a file, bound in place of the output.
+    Passed on as is when another probe wants the output as a file or on stdin
+    """
+
+
+# Files written for {name:file} placeholders and "stdin", by path, with the number of probes using each
+input_files = {}
+input_files_lock = threading.Lock()
+
+
+def acquire_input_file(value, folder=None):
+    """
+    Write a value to a file named after its content hash, so probes delivering the same value share one file
+    and their commands stay the same between runs. Pass the path to release_input_file() when done
+    :return: the file's path
+    """
+    data = str(value).encode('utf-8')
+    folder = folder or tempfile.gettempdir()
+    path = os.path.join(folder, 'saad-input-' + hashlib.sha1(data).hexdigest())
+    input_files_lock.acquire()
+    try:
+        if path in input_files:
+            input_files[path] += 1
+        else:
+            os.makedirs(folder, exist_ok=True)
+            with tempfile.NamedTemporaryFile(prefix='saad-input-', dir=folder, delete=False) as file:
+                file.write(data)
+            os.replace(file.name, path)
+            input_files[path] = 1
+    finally:
+        input_files_lock.release()
+    return path
+
+
+def release_input_file(path):
+    """
+    Delete an input file once no probe uses it anymore
+    """
+    input_files_lock.acquire()
+    input_files[path] -= 1
+    if input_files[path] == 0:
+        del input_files[path]
+        remove_output_file(path)
+    input_files_lock.release()
+
+
+def remove_output_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        logging.debug("Spilled output %s was already removed", path)
+
+
+class LazyCheckout:
+    """
+    Binding for a commit that is only resolved when it's first needed, and only checked out when a probe using it
+    is about to start. The checkout stays pinned in the repo's checkout cache until release() is called
+    """
+    def __init__(self, repo, commit):
+        """
+        :param commit: the commit's name, e.g. a hash, a branch or 'current'
+        """
+        self.repo = repo
+        self.commit = commit
+        self.lock = threading.Lock()
+        self.resolved = False
+        self.hash = None
+        self.checkout = None
+        self.released = False
+
+    def resolve(self):
+        """
+        Resolve the commit to its hash, the first time it's called
+        :return: the hash, or None if the repository doesn't have the commit, like the zero commit a push creating
+        a branch starts from, or a commit dropped by a force push
+        """
+        self.lock.acquire()
+        try:
+            if not self.resolved:
+                try:
+                    self.hash = self.repo.rev_parse(self.commit)
+                except subprocess.CalledProcessError:
+                    logging.debug("Couldn't find commit %s in %s", self.commit, self.repo.name)
+                self.resolved = True
+            return self.hash
+        finally:
+            self.lock.release()
+
+    def get(self):
+        """
+        Check the commit out if it isn't yet
+        :return: the checkout's directory
+        """
+        commit = self.resolve()
+        if commit is None:
+            raise ValueError("Commit " + self.commit + " doesn't exist")
+        self.lock.acquire()
+        try:
+            if self.checkout is None:
+                self.checkout = self.repo.get_checkout(commit, not self.released)
+            return self.checkout.name
+        finally:
+            self.lock.release()
+
+    def get_path(self):
+        """
+        :return: the checkout's directory, or None if the commit hasn't been checked out
+        """
+        checkout = self.checkout
+        return checkout.name if checkout is not None else None
+
+    def release(self):
+        """
+        Let the checkout be evicted from the checkout cache
+        """
+        self.lock.acquire()
+        if self.checkout is not None and not self.released:
+            self.repo.get_checkouts().unpin(self.checkout)
+        self.released = True
+        self.lock.release()
+
+    def __str__(self):
+        return self.get()
+
+
+def materialize_checkouts(checkouts):
+    """
+    Check out every LazyCheckout in checkouts, in parallel
+    """
+    threads = [threading.Thread(target=checkout.get, daemon=True) for checkout in checkouts[1:]]
+    for thread in threads:
+        thread.start()
+    try:
+        if checkouts:
+            checkouts[0].get()
+    finally:
+        for thread in threads:
+            thread.join()
+
+
+class ProbeRun:
+    """
+    Keeps track of every probe started as part of one run, so callers can wait for the whole run
+    """
+    def __init__(self, changed_paths=None):
+        """
+        :param changed_paths: the paths changed between the run's commits, or None if they aren't known
+        """
+        self.lock = threading.Lock()
+        self.changed_paths = changed_paths
+        # Probes that have been queued or are running
+        self.pending = 0
+        self.finished = threading.Event()
+        self.finished.set()
+        # Results of the probes run so far, by module, populated command and environment
+        self.shared = {}
+        # Called the next time the run finishes
+        self.callbacks = []
+        # Id of the run in the probe database, when it was recorded
+        self.id = None
+
+    def add(self):
+        self.lock.acquire()
+        self.pending += 1
+        self.finished.clear()
+        self.lock.release()
+
+    def done(self):
+        self.lock.acquire()
+        self.pending -= 1
+        if self.pending > 0:
+            self.lock.release()
+            return
+        callbacks, self.callbacks = self.callbacks, []
+        self.lock.release()
+        # Waiters only wake up once the callbacks are done, e.g. once spilled output is deleted
+        for callback in callbacks:
+            callback()
+        self.lock.acquire()
+        if self.pending == 0:
+            self.finished.set()
+        self.lock.release()
+
+    def when_finished(self, callback):
+        """
+        Call callback once no probe of the run is queued or running, right away if that's already the case
+        """
+        self.lock.acquire()
+        if self.pending > 0:
+            self.callbacks.append(callback)
+            callback = None
+        self.lock.release()
+        if callback is not None:
+            callback()
+
+    def share(self, key):
+        """
+        Get the shared result for probes with the given key, so identical probes only run once per run
+        :return: (future, leader). The leader is the first probe with the key, and has to set the future's result
+        """
+        self.lock.acquire()
+        leader = key not in self.shared
+        if leader:
+            self.shared[key] = Future()
+        future = self.shared[key]
+        self.lock.release()
+        return future, leader
+
+    def wait(self, timeout=None):
+        """
+        Block until no probe of the run is queued or running anymore.
+        Probes whose dependencies never finished are not waited on, since they can't start.
+        :return: False if the timeout expired first
+        """
+        return self.finished.wait(timeout)
+
+
+class ProbeScheduler:
+    """
+    Runs ready probes on a fixed-size pool of worker threads instead of a thread per probe
+    """
+    # Scopes release probes to the scheduler one at a time as their dependencies finish
+    resolves_dependencies = False
+
+    def __init__(self, workers=DEFAULT_PROBE_WORKERS):
+        self.lock = threading.Lock()
+        # Entries are (priority, insertion order, probe, run) so equal priorities run first come first serve
+        self.ready = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.closed = False
+        self.workers = []
+        for i in range(max(1, int(workers))):
+            worker = threading.Thread(target=self.__work__, name="probe-worker-" + str(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        schedulers.append(self)
+
+    def submit(self, probe, run=None, priority=0):
+        """
+        Queue a probe whose dependencies are all satisfied. Higher priorities are started first.
+        """
+        self.lock.acquire()
+        if self.closed:
+            self.lock.release()
+            raise RuntimeError("Probe scheduler has been shut down")
+        if run is not None:
+            run.add()
+        self.ready.put((-priority, next(self.order), probe, run))
+        self.lock.release()
+
+    def __work__(self):
+        while True:
+            _, _, probe, run = self.ready.get()
+            if probe is None:
+                # Shutdown marker
+                return
+            try:
+                probe.run()
+            except Exception:
+                logging.exception("Probe %s failed to run", probe)
+            finally:
+                if run is not None:
+                    run.done()
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting probes and stop the workers once the already queued probes have run
+        """
+        self.lock.acquire()
+        if not self.closed:
+            self.closed = True
+            for _ in self.workers:
+                # Sorts after every real entry, so the queue drains first
+                self.ready.put((float('inf'), next(self.order), None, None))
+        self.lock.release()
+        if wait:
+            for worker in self.workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+
+
+class AsyncProbeEngine:
+    """
+    Runs probe DAGs on an asyncio event loop using asyncio subprocesses, so long running probes
+    (fuzzers, sleeps) don't each tie up a thread. Dependencies are resolved by awaiting futures.
+    """
+    # Scopes hand whole DAGs to the engine instead of releasing probes one by one
+    resolves_dependencies = True
+
+    def __init__(self, limit=DEFAULT_ASYNC_PROBE_LIMIT):
+        self.limit = max(1, int(limit))
+        self.closed = False
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="probe-event-loop", daemon=True)
+        self.thread.start()
+        # Caps how many probe subprocesses run at once. Created on the loop it's used from
+        self.semaphore = asyncio.run_coroutine_threadsafe(self.__make_semaphore__(), self.loop).result()
+        schedulers.append(self)
+
+    async def __make_semaphore__(self):
+        return asyncio.Semaphore(self.limit)
+
+    def run_scope(self, scope):
+        """
+        Run every probe of scope once the probes it depends on have finished
+        :return: a concurrent.futures.Future that completes when the whole scope is done
+        """
+        return self.__schedule__(self.__run_scope__(scope), scope.run)
+
+    def submit(self, probe, run=None, priority=0):
+        """
+        Run a single probe that doesn't depend on any other probe
+        """
+        return self.__schedule__(self.__run_probe__(probe), run)
+
+    def __schedule__(self, coroutine, run):
+        if self.closed:
+            coroutine.close()
+            raise RuntimeError("Probe engine has been shut down")
+        if run is not None:
+            run.add()
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        if run is not None:
+            future.add_done_callback(lambda f: run.done())
+        return future
+
+    async def __run_scope__(self, scope):
+        plan = scope.plan
+        # Each future is set to whether its probe ran, so probes depending on a skipped probe are skipped too
+        results = {i: self.loop.create_future() for i in plan.order}
+        # Probes starting the longest chains queue up on the semaphore first
+        order = sorted(plan.order, key=plan.priority, reverse=True)
+        await asyncio.gather(*[self.__run_dependent__(plan.probes[i], [results[d] for d in plan.dependencies[i]],
+                                                      results[i])
+                               for i in order])
+
+    async def __run_dependent__(self, probe, dependencies, result):
+        ran = False
+        try:
+            ran = all([await dependency for dependency in dependencies])
+            if ran:
+                ran = await self.__run_probe__(probe)
+            else:
+                probe.skip()
+        finally:
+            result.set_result(ran)
+
+    async def __run_probe__(self, probe):
+        async with self.semaphore:
+            try:
+                return await probe.run_async()
+            except Exception:
+                # The probe finished with the error as its errors, so probes depending on it run like after
+                # any other error
+                logging.exception("Probe %s failed to run", probe)
+                return True
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting probes. With wait, let the running probes finish before stopping the loop
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if wait:
+            asyncio.run_coroutine_threadsafe(self.__drain__(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if wait:
+            self.thread.join()
+
+    async def __drain__(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Every scheduler that has been created, so they can all be shut down together
+schedulers = []
+default_scheduler = None
+default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler():
+    """
+    Get the scheduler shared by repos that don't configure their own pool
+    """
+    global default_scheduler
+    default_scheduler_lock.acquire()
+    if default_scheduler is None:
+        default_scheduler = ProbeScheduler(DEFAULT_PROBE_WORKERS)
+    default_scheduler_lock.release()
+    return default_scheduler
+
+
+def shutdown_schedulers(wait=True):
+    for scheduler in list(schedulers):
+        scheduler.shutdown(wait)
+
+
+def order_probes(dependencies, probes_waiting_on):
+    """
+    Order probes so that each one comes after the probes it depends on, with Kahn's algorithm
+    :param dependencies: the internal names of the probes each probe waits on
+    :param probes_waiting_on: the internal names of the probes waiting on each probe
+    :return: the order, and how many of its dependencies each probe is still waiting on.
+    Probes in a dependency cycle, or waiting on one, are left out of the order
+    """
+    counts = {i: len(waiting) for i, waiting in dependencies.items()}
+    ready = [i for i in sorted(dependencies) if counts[i] == 0]
+    order = []
+    while ready:
+        probe = ready.pop()
+        order.append(probe)
+        for waiting in probes_waiting_on[probe]:
+            counts[waiting] -= 1
+            if counts[waiting] == 0:
+                ready.append(waiting)
+    return order, counts
+
+
+class ProbePlan:
+    """
+    The probes of a scope compiled into a DAG: a topological order, the dependencies of each probe and
+    the length of the longest chain of probes each one starts, which is used as its priority
+    """
+    def __init__(self, probes, probes_waiting_on, probe_names):
+        """
+        :raises ValueError: if the probes depend on each other in a cycle
+        """
+        self.probes = probes
+        self.waiting_on = probes_waiting_on
+        self.dependencies = {i: [] for i in range(len(probes))}
+        for dependency, waiting in probes_waiting_on.items():
+            for probe in waiting:
+                self.dependencies[probe].append(dependency)
+        self.labels = {internal: name for name, internal in probe_names.items()}
+
+        self.order, counts = order_probes(self.dependencies, probes_waiting_on)
+        if len(self.order) < len(probes):
+            raise ValueError("Probe dependency cycle: " + " -> ".join(self.find_cycle(counts)))
+
+        # Number of probes in the longest chain starting at each probe
+        self.critical_path = {}
+        for probe in reversed(self.order):
+            self.critical_path[probe] = 1 + max([self.critical_path[waiting] for waiting in probes_waiting_on[probe]],
+                                                default=0)
+
+    def label(self, internal_name):
+        if internal_name in self.labels:
+            return self.labels[internal_name]
+        return self.probes[internal_name].headers['type'] + " #" + str(internal_name)
+
+    def find_cycle(self, counts):
+        """
+        Get the labels of one cycle among the probes that never became ready
+        """
+        # Every probe left over is waiting on at least one other left over probe, so walking back along
+        # dependencies has to revisit a probe eventually
+        probe = next(i for i, count in counts.items() if count > 0)
+        path = []
+        while probe not in path:
+            path.append(probe)
+            probe = next(d for d in self.dependencies[probe] if counts[d] > 0)
+        cycle = path[path.index(probe):] + [probe]
+        return [self.label(i) for i in reversed(cycle)]
+
+    def priority(self, internal_name):
+        return self.critical_path[internal_name]
+
+
 class Scope:
     """
     Manages bindings and ensures that probes run after the probes they depend on
     """
-    def __init__(self, bindings):
+    def __init__(self, bindings, scheduler=None, run=None, files=None):
         """
-        Create an instance with the given bindings
+        Create an instance with the given bindings.
+        Unblocked probes are handed to scheduler, and counted as part of run if one is given
+        :param files: function reading a file at a commit binding, e.g. files('HEAD', 'version.txt'),
+        used for {HEAD:version.txt} placeholders. Returns the contents as bytes, or None if there is no such file
         """
         #Lock used due to multithreading
         self.lock = threading.Lock()
         self.lock.acquire()
+        self.scheduler = scheduler
+        self.run = run
+        self.files = files
         self.bindings = {}
         for binding in bindings.keys():
             self.bindings[binding] = bindings[binding]
@@ -167,6 +1230,10 @@ class Scope:
         self.blocking_counts = {}
         # Which probes are blocked by a given probe
         self.probes_waiting_on = {}
+        # Set by compile() once all dependencies are registered
+        self.plan = None
+        # Internal names of the probes that were skipped, or depend on a skipped probe
+        self.skipped = set()
         self.lock.release()
 
     def bind_vars(self, bindings):
@@ -183,15 +1250,17 @@ class Scope:
         Add a Probe object to the list of probes in this scope
         """
         self.lock.acquire()
-        internal_name = len(self.probes)
-        self.probes.append(probe)
-        if name is not None:
-            if name in self.probe_names:
-                raise ValueError("Duplicate Probe Name")
-            self.probe_names[name] = internal_name
-        self.blocking_counts[internal_name] = 0
-        self.probes_waiting_on[internal_name] = []
-        self.lock.release()
+        try:
+            if name is not None and name in self.probe_names:
+                raise ValueError("Duplicate probe name " + name)
+            internal_name = len(self.probes)
+            self.probes.append(probe)
+            if name is not None:
+                self.probe_names[name] = internal_name
+            self.blocking_counts[internal_name] = 0
+            self.probes_waiting_on[internal_name] = []
+        finally:
+            self.lock.release()
 
     def register_probe_dependency(self, probe, dependency_name):
         """
@@ -215,6 +1284,10 @@ class Scope:
         self.lock.acquire()
         self.bindings[probe_name] = result
         name = self.probe_names[probe_name]
+        if self.scheduler is not None and self.scheduler.resolves_dependencies:
+            # The engine is already waiting on this probe's result
+            self.lock.release()
+            return
         if name in self.probes_waiting_on:
             if len(self.probes_waiting_on[name]) != 0:
                 #Reduce the wait counts for any probes that were waiting on me
@@ -222,10 +1295,91 @@ class Scope:
                     self.blocking_counts[probe] -= 1
                     #Start any probes that are now unblocked
                     if self.blocking_counts[probe] == 0:
-                        thread = threading.Thread(target=self.probes[probe].run, args=())
-                        thread.start()
+                        self.__submit__(probe)
+        self.lock.release()
+
+    def skip_dependents(self, probe):
+        """
+        Skip the probes waiting on a skipped probe, since they can't run without its result
+        """
+        if self.scheduler is not None and self.scheduler.resolves_dependencies:
+            # The engine skips them itself
+            return
+        self.lock.acquire()
+        waiting = []
+        for internal_name in self.probes_waiting_on[self.probes.index(probe)]:
+            if internal_name not in self.skipped:
+                self.skipped.add(internal_name)
+                waiting.append(self.probes[internal_name])
+        self.lock.release()
+        for dependent in waiting:
+            dependent.skip()
+
+    def compile(self):
+        """
+        Compile the registered probes and dependencies into a ProbePlan
+        :raises ValueError: if the probes depend on each other in a cycle
+        """
+        self.lock.acquire()
+        try:
+            self.plan = ProbePlan(self.probes, self.probes_waiting_on, self.probe_names)
+        finally:
+            self.lock.release()
+        return self.plan
+
+    def drop_cycles(self):
+        """
+        Take the probes that could never run out of the scope before it is compiled: the ones in a dependency
+        cycle, and the ones waiting on those
+        :return: the dropped probes
+        """
+        self.lock.acquire()
+        try:
+            dependencies = {i: [] for i in range(len(self.probes))}
+            for dependency, waiting in self.probes_waiting_on.items():
+                for probe in waiting:
+                    dependencies[probe].append(dependency)
+            order, counts = order_probes(dependencies, self.probes_waiting_on)
+            # Kept probes only wait on kept probes, so just the internal names need to change
+            kept = sorted(order)
+            internal_names = {old: new for new, old in enumerate(kept)}
+            dropped = [self.probes[i] for i in range(len(self.probes)) if i not in internal_names]
+            self.probes = [self.probes[i] for i in kept]
+            self.probe_names = {name: internal_names[i] for name, i in self.probe_names.items()
+                                if i in internal_names}
+            self.blocking_counts = {internal_names[i]: self.blocking_counts[i] for i in kept}
+            self.probes_waiting_on = {internal_names[i]: [internal_names[waiting]
+                                                          for waiting in self.probes_waiting_on[i]
+                                                          if waiting in internal_names]
+                                      for i in kept}
+            self.plan = None
+        finally:
+            self.lock.release()
+        return dropped
+
+    def start(self):
+        """
+        Hand every probe that isn't waiting on another probe to the scheduler
+        """
+        if self.plan is None:
+            self.compile()
+        if self.scheduler is not None and self.scheduler.resolves_dependencies:
+            self.scheduler.run_scope(self)
+            return
+        self.lock.acquire()
+        for probe_name, count in self.blocking_counts.items():
+            if count == 0:
+                self.__submit__(probe_name)
         self.lock.release()
 
+    def __submit__(self, internal_name):
+        # Callers hold self.lock
+        if internal_name in self.skipped:
+            return
+        if self.scheduler is None:
+            self.scheduler = get_default_scheduler()
+        self.scheduler.submit(self.probes[internal_name], self.run, self.plan.priority(internal_name))
+
     def get(self, lookup):
         """
         Getter for bindings
@@ -236,18 +1390,92 @@ class Scope:
             return False, None
         return True, None
 
-    def get_dependencies(self, string):
+    def get_dependencies(self, string, namespace=None):
         """
         Get all of the values that still have not been bound
         """
-        matches = re.finditer(r'{([a-zA-Z0-9_~]+)}', str(string))
         dependencies = []
-        for match in matches:
-            bound, result = self.get(match.group(1))
+        for name in compile_template(string).names:
+            if name.endswith(FILE_SUFFIX):
+                name = name[:-len(FILE_SUFFIX)]
+            name = self.resolve(name, namespace)
+            bound, result = self.get(name)
             if bound and result is None:
-                dependencies.append(match.group(1))
+                dependencies.append(name)
         return dependencies
 
+    def resolve(self, name, namespace=None):
+        """
+        Get the full name of a probe referenced from namespace.
+        In a shared scope, {user} in a file refers to that file's own "user" probe if it has one
+        """
+        if namespace:
+            qualified = namespace + "." + name
+            if qualified in self.probe_names:
+                return qualified
+        return name
+
+    def values_for(self, names, namespace=None):
+        """
+        Get the values bound to names as seen from namespace, like bindings_for() but only copying what's needed
+        """
+        self.lock.acquire()
+        values = {}
+        for name in names:
+            resolved = self.resolve(name, namespace)
+            if resolved in self.bindings:
+                values[name] = self.bindings[resolved]
+            elif name in self.bindings:
+                values[name] = self.bindings[name]
+        self.lock.release()
+        return values
+
+    def bindings_for(self, namespace=None):
+        """
+        Get the bindings as seen from namespace, with the namespace's own probes also under their short names.
+        Callers hold self.lock
+        """
+        if not namespace:
+            return self.bindings
+        bindings = self.bindings.copy()
+        prefix = namespace + "."
+        for name, value in self.bindings.items():
+            if name.startswith(prefix):
+                bindings[name[len(prefix):]] = value
+        return bindings
+
+    def lazy_checkouts(self, templates, namespace=None):
+        """
+        Get the LazyCheckout bindings referenced in compiled templates, e.g. by {HEAD}
+        """
+        names = set()
+        for template in templates:
+            names.update(template.names)
+        values = self.values_for(names, namespace)
+        checkouts = []
+        for value in values.values():
+            if isinstance(value, LazyCheckout) and value not in checkouts:
+                checkouts.append(value)
+        return checkouts
+
+    def file_bindings(self, templates):
+        """
+        Read the files referenced in compiled templates as {commit:path}, like {HEAD:version.txt}, without a checkout
+        :return: bindings for the referenced files that exist
+        """
+        bindings = {}
+        if self.files is None:
+            return bindings
+        for template in templates:
+            for name in template.names:
+                if ':' not in name or name in bindings:
+                    continue
+                commit, path = name.split(':', 1)
+                contents = self.files(commit, path)
+                if contents is not None:
+                    bindings[name] = contents.decode('utf-8', 'replace')
+        return bindings
+
     def __str__(self):
         return str(self.bindings)
 
@@ -283,9 +1511,13 @@ class Repo:
         self.repo = repo_path
         self.name = repo_name
         self.commits = {}
+        self.checkouts = None
         self.modules = {}
         self.running_probes = []
         self.probe_lock = threading.Lock()
+        self.scheduler = None
+        self.worker_pool = None
+        self.result_cache = None
         self.config = {}
         self.inherited_config = {}
         self.child_repos = {}
@@ -337,10 +1569,11 @@ class Repo:
         """
         saad_config = {}
         config_parser = configparser.ConfigParser()
+        # Relative paths are in the commit's checkout, or the server root
+        code_dir = self.config['root_path']
         if commit is not None:
             code_dir = self.get_commit(commit)
-            if os.path.isdir(code_dir):
-                os.chdir(code_dir)
+        path = os.path.join(code_dir, path)
         if os.path.isfile(path):
             config_parser.read(path)
         else:
@@ -364,8 +1597,6 @@ class Repo:
                         self.config[section] = {}
                     self.config[section][key] = config_parser[section].get(key, key)
 
-        os.chdir(self.config['root_path'])
-
     def reload_all_modules(self, commit=None):
         """
         Get all of the modules for this repo at a given commit
@@ -383,7 +1614,7 @@ class Repo:
         Load all of the modules at a given file path.
         """
         if commit is not None:
-            path = os.path.join(os.path.dirname(os.path.abspath(self.commits[commit].name)), path)
+            path = os.path.join(os.path.dirname(os.path.abspath(self.get_commit(commit))), path)
         else:
             path = os.path.join(self.config['root_path'], path)
         for config in all_json_in_dir(path):
@@ -402,6 +1633,46 @@ class Repo:
         self.probe_lock.release()
         return out
 
+    def get_worker_pool(self):
+        """
+        Get the worker processes for this repo's callable modules. Repos without a WorkerProcesses setting
+        share their parent's
+        """
+        if self.worker_pool is None:
+            if 'workerprocesses' in self.config or self.parent is None:
+                size = DEFAULT_WORKER_PROCESSES
+                max_jobs = DEFAULT_WORKER_MAX_JOBS
+                max_memory = DEFAULT_WORKER_MAX_MEMORY
+                if 'workerprocesses' in self.config:
+                    size = int(split_config_list(self.config['workerprocesses'])[0])
+                if 'workermaxjobs' in self.config:
+                    max_jobs = int(split_config_list(self.config['workermaxjobs'])[0])
+                if 'workermaxmemory' in self.config:
+                    max_memory = int(split_config_list(self.config['workermaxmemory'])[0])
+                self.worker_pool = WorkerPool(size, max_jobs, max_memory, self.config['root_path'])
+            else:
+                return self.parent.get_worker_pool()
+        return self.worker_pool
+
+    def get_result_cache(self):
+        """
+        Get the probe result cache set with ResultCache. Repos without the setting use their parent's
+        :return: None if result caching is off
+        """
+        if self.result_cache is None:
+            if 'resultcache' in self.config:
+                path = os.path.join(self.config['root_path'], split_config_list(self.config['resultcache'])[0])
+                max_size = DEFAULT_RESULT_CACHE_SIZE
+                max_entries = DEFAULT_RESULT_CACHE_ENTRIES
+                if 'resultcachesize' in self.config:
+                    max_size = int(split_config_list(self.config['resultcachesize'])[0])
+                if 'resultcacheentries' in self.config:
+                    max_entries = int(split_config_list(self.config['resultcacheentries'])[0])
+                self.result_cache = ResultCache(path, max_size, max_entries)
+            elif self.parent:
+                return self.parent.get_result_cache()
+        return self.result_cache
+
     def load_probe_json(self):
         """
         Get all of the defined probes for this repo
@@ -410,114 +1681,325 @@ class Repo:
             print("No probes specified to run")
             return []
         output = []
-        for filepath in split_config_list(self.config['probefolders']):
-            path = os.path.join(self.get_commit('current'), filepath)
-            if not os.path.isdir(path):
-                print("No probes found at " + path)
-                continue
-            output.extend(list(all_json_in_dir(path)))
+        for folder, path, configs in self.probe_files(self.rev_parse('current')):
+            output.append(configs)
         return output
 
+    def probe_files(self, commit):
+        """
+        Read every probe file at a commit straight from the object store, without checking the commit out
+        :return: generator of (probe folder, file path, parsed probes), with paths relative to the repo root
+        """
+        checkouts = self.get_checkouts()
+        for folder in split_config_list(self.config['probefolders']):
+            paths = [path for path in checkouts.list_files(commit, folder) if path.endswith(".json")]
+            if not paths:
+                print("No probes found at " + folder)
+            for path in paths:
+                yield folder, path, json.loads(checkouts.read_file(commit, path))
+
+    def read_file(self, commit_name, path):
+        """
+        Read a file at a commit, e.g. read_file('current', 'version.txt'), without checking the commit out
+        :return: the file's contents as bytes, or None if there is no such file
+        """
+        return self.get_checkouts().read_file(self.rev_parse(commit_name), path)
+
     def get_modules(self):
         return self.modules
 
+    def get_scheduler(self):
+        """
+        Get the scheduler for this repo's probes. Repos without a ProbeWorkers or ProbeEngine setting share
+        their parent's
+        """
+        if self.scheduler is None:
+            if 'probeengine' in self.config and split_config_list(self.config['probeengine'])[0].lower() == 'asyncio':
+                limit = DEFAULT_ASYNC_PROBE_LIMIT
+                if 'asyncprobelimit' in self.config:
+                    limit = int(split_config_list(self.config['asyncprobelimit'])[0])
+                self.scheduler = AsyncProbeEngine(limit)
+            elif 'probeworkers' in self.config:
+                self.scheduler = ProbeScheduler(int(split_config_list(self.config['probeworkers'])[0]))
+            elif self.parent:
+                return self.parent.get_scheduler()
+            else:
+                return get_default_scheduler()
+        return self.scheduler
+
+    def get_checkouts(self):
+        """
+        Get the CheckoutManager holding this repo's objects and commit checkouts
+        """
+        if self.checkouts is None:
+            mirror = None
+            mirror_folder = self.get_mirror_folder()
+            if mirror_folder is not None:
+                mirror = os.path.join(mirror_folder, self.name + ".git")
+            max_size = int(self.get_server_setting('checkoutcachesize', DEFAULT_CHECKOUT_CACHE_SIZE))
+            max_entries = int(self.get_server_setting('checkoutcacheentries', DEFAULT_CHECKOUT_CACHE_ENTRIES))
+            folder = self.get_server_setting('checkoutfolder')
+            sparse_paths = None
+            if str(self.get_server_setting('sparsecheckout', False)).lower() == 'true':
+                sparse_paths = self.get_sparse_paths
+            self.checkouts = CheckoutManager(self.repo, mirror, max_size, max_entries, folder, sparse_paths)
+        return self.checkouts
+
+    def get_sparse_paths(self, commit):
+        """
+        Get the paths to check out of a commit with SparseCheckout: the config, module and probe folders, and
+        every path the commit's probes reference in their inputs, like {HEAD}/{file}, or watch with "paths"
+        :return: sparse-checkout patterns, or None if a probe could read any file and everything is needed
+        """
+        patterns = set()
+        for key in ('configfiles', 'modulefolders'):
+            if key in self.config:
+                patterns.update("/" + path.strip("/") for path in split_config_list(self.config[key]) if path)
+        if 'probefolders' not in self.config:
+            return sorted(patterns)
+        for folder in split_config_list(self.config['probefolders']):
+            patterns.add("/" + folder.strip("/") + "/")
+        for folder, path, configs in self.probe_files(commit):
+            for probe_config in configs:
+                if probe_config.get('type') not in modules:
+                    continue
+                paths = probe_paths(probe_config, modules[probe_config['type']])
+                if paths is None:
+                    logging.info("Checking out all of %s, since a probe in %s reads files it can't predict",
+                                 commit, path)
+                    return None
+                patterns.update(paths)
+        return sorted(patterns)
+
+    def get_server_setting(self, key, default=None):
+        """
+        Get a setting from this repo's config, or its parent's if it doesn't set it
+        """
+        if key in self.config:
+            return split_config_list(self.config[key])[0]
+        elif self.parent:
+            return self.parent.get_server_setting(key, default)
+        return default
+
+    def get_mirror_folder(self):
+        """
+        Get the folder set with MirrorFolder, where repos keep persistent mirrors. Repos without the setting
+        use their parent's
+        :return: None if mirrors aren't kept
+        """
+        if 'mirrorfolder' in self.config:
+            return os.path.join(self.config['root_path'], split_config_list(self.config['mirrorfolder'])[0])
+        elif self.parent:
+            return self.parent.get_mirror_folder()
+        return None
+
+    def fetch(self):
+        """
+        Fetch new commits into the repo's object store, so 'current' is checked out again at the new HEAD
+        """
+        self.get_checkouts().fetch()
+        current = self.commits.pop('current', None)
+        if current is not None:
+            self.get_checkouts().unpin(current)
+
     def get_current(self):
         """
-        Load the most recent commit
+        Load the most recent commit. It stays pinned in the checkout cache until the next fetch
         """
-        self.commits['current'] = tempfile.TemporaryDirectory()
+        current = self.commits.pop('current', None)
+        if current is not None:
+            self.get_checkouts().unpin(current)
+        self.commits['current'] = self.get_checkouts().checkout('HEAD', True)
         print(self.commits['current'].name)
-        print("################")
-        print("Cloning commit current...\n")
-        os.chdir(self.commits['current'].name)
-        os.system("git clone " + self.repo + " .")
-        os.system("git config --local advice.detachedHead false")
-        os.chdir(self.config['root_path'])
+
+    def get_checkout(self, commit_name, pin=False):
+        """
+        Get the Checkout of the specified commit from the checkout cache, checking it out if needed
+        :param pin: keep it from being evicted until it is passed to CheckoutManager.unpin()
+        """
+        if commit_name == 'current':
+            if 'current' not in self.commits or not os.path.isdir(self.commits['current'].name):
+                self.get_current()
+            commit_name = self.commits['current'].commit
+        return self.get_checkouts().checkout(commit_name, pin)
 
     def get_commit(self, commit_name):
         """
         Load the specified commit into a temp directory
+        :return: the directory
+        """
+        return self.get_checkout(commit_name).name
+
+    def get_changed_paths(self, new_commit, old_commit):
+        """
+        Get every path added, modified, deleted or renamed between two commits, using git diff --name-status
+        :return: sorted list of paths relative to the repo root, or None if the commits can't be compared
+        """
+        try:
+            output = subprocess.check_output(['git', 'diff', '--name-status', '-z', '--no-renames',
+                                              self.rev_parse(old_commit), self.rev_parse(new_commit)],
+                                             cwd=self.get_checkouts().get_store(), stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, OSError):
+            logging.warning("Couldn't find the paths changed between %s and %s", old_commit, new_commit)
+            return None
+        # -z output alternates between a status and the path it applies to
+        fields = output.decode('utf-8').split('\0')
+        return sorted(set(fields[1::2]) - {''})
+
+    def rev_parse(self, commit_name):
+        """
+        Resolve a commit name to its hash. 'current' is the commit checked out by get_current
         """
-        #First load the current commit, so we can use it to parse git commit name shorthand
-        if 'current' not in self.commits:
-            self.get_current()
-        else:
-            if not os.path.isdir(self.commits['current'].name):
-                self.get_current()
-        os.chdir(self.commits['current'].name)
         if commit_name == 'current':
-            return self.commits['current'].name
-        commit_name = subprocess.check_output(['git', 'rev-parse', commit_name]).decode("utf-8")
-        
-        #Then check if the commit specified is already loaded
-        if commit_name in self.commits:
-            if os.path.isdir(self.commits[commit_name].name):
-                return self.commits[commit_name].name
-        #Load it if it isn't.
-        self.commits[commit_name] = tempfile.TemporaryDirectory()
-        print("################")
-        print("Cloning commit " + commit_name + "...\n")
-        os.chdir(self.commits[commit_name].name)
-        os.system("git clone " + self.repo + " .")
-        os.system("git config --local advice.detachedHead false")
-        os.system("git checkout " + commit_name)
-        os.chdir(self.config['root_path'])
-        return self.commits[commit_name].name
+            if 'current' in self.commits:
+                return self.commits['current'].commit
+            commit_name = 'HEAD'
+        return self.get_checkouts().rev_parse(commit_name)
 
     def run_all_probes(self, new_commit, old_commit):
         """
         Run all of the probe files for this repository
+        :return: the ProbeRun tracking the started probes
         """
         if 'probefolders' not in self.config:
             print("No probes specified to run")
-            return
+            return ProbeRun()
 
         logging.debug('New commit: {}'.format(new_commit))
         logging.debug('Old commit: {}'.format(old_commit))
         logging.debug('self.commits: {}'.format(self.commits))
 
-        for filepath in split_config_list(self.config['probefolders']):
-            path = os.path.join(self.get_commit(new_commit), filepath)
-            if not os.path.isdir(path):
-                print("No probes found at " + path)
-                continue
+        # The new commit's probe files are read right away, so it has to exist
+        commits = {"HEAD": self.rev_parse(new_commit)}
+        # Default variables that can be accessed in module/monitoring configs.
+        # The commits are only checked out once a probe using them starts
+        default_variables = {"HEAD": LazyCheckout(self, commits["HEAD"])}
+        previous = LazyCheckout(self, old_commit)
+        changed_paths = None
+        if previous.resolve() is not None:
+            commits["HEAD~1"] = previous.resolve()
+            default_variables["HEAD~1"] = previous
+            # Computed once per run, so probes watching files don't each have to diff the checkouts
+            changed_paths = self.get_changed_paths(commits["HEAD"], commits["HEAD~1"])
+        else:
+            # E.g. a push creating a branch. Probes still run, with {HEAD~1} left unbound and no changed paths
+            logging.warning("Running probes of %s without {HEAD~1}, since %s doesn't exist", self.name, old_commit)
+        run = ProbeRun(changed_paths)
+        run.id = probe_logger.log_run(self.name, commits.get("HEAD~1"), commits["HEAD"], int(time.time()))
+        # Keeps the run from finishing before every scope has started
+        run.add()
+        for checkout in default_variables.values():
+            run.when_finished(checkout.release)
+        if changed_paths is not None:
+            default_variables["CHANGED_FILES"] = "\n".join(changed_paths)
+        # {HEAD:path} placeholders are read straight from the object store
+        files = lambda name, path: self.get_checkouts().read_file(commits[name], path) if name in commits else None
+        try:
+            # With SharedScope, every probe file goes into one scope so probes can be shared between files
+            shared_scope = None
+            shared_probes = []
+            # Probe files by namespace, since e.g. a/b.json and a.b.json would both be a.b
+            namespaces = {}
+            if 'sharedscope' in self.config and split_config_list(self.config['sharedscope'])[0].lower() == 'true':
+                shared_scope = Scope(default_variables, self.get_scheduler(), run, files)
 
-            # Default variables that can be accessed in module/monitoring configs
-            default_variables = {
-                "HEAD": self.get_commit(new_commit),
-                "HEAD~1": self.get_commit(old_commit)
-            }
             # Loop over all files
-            for configs in all_json_in_dir(path):
-                scope = Scope(default_variables)
-                # Initialize Probes
-                probes = []
-                for probe_config in configs:
-                    probe = Probe(probe_config, scope, self)
-                    probes.append(probe)
-                # Get the dependencies set
-                for probe in probes:
-                    probe.prep_input_dependencies()
-                # Start all unblocked probes
-                scope.lock.acquire()
-                data = scope.blocking_counts
-                for probe_name in data.keys():
-                    if data[probe_name] == 0:
-                        thread = threading.Thread(target=scope.probes[probe_name].run, args=())
-                        thread.start()
-                        #scope.probes[probe_name].run()
-                scope.lock.release()
+            for folder, config_path, configs in self.probe_files(commits["HEAD"]):
+                try:
+                    check_probe_configs(configs)
+                except ValueError as e:
+                    logging.error("Not running probes in %s: %s", config_path, e)
+                    continue
+                if shared_scope is not None:
+                    namespace = probe_file_namespace(folder, config_path)
+                    if namespace in namespaces:
+                        logging.error("Not running probes in %s: its namespace %s is already used by %s",
+                                      config_path, namespace, namespaces[namespace])
+                        continue
+                    # Dotted probe names can collide too, like b.c in a.json and c in a/b.json
+                    taken = [namespace + "." + probe_config['name'] for probe_config in configs
+                             if 'name' in probe_config and
+                             namespace + "." + probe_config['name'] in shared_scope.probe_names]
+                    if taken:
+                        logging.error("Not running probes in %s: probe names %s are already used by another file",
+                                      config_path, ", ".join(taken))
+                        continue
+                    namespaces[namespace] = config_path
+                    for probe_config in configs:
+                        shared_probes.append(Probe(probe_config, shared_scope, self, namespace))
+                    continue
+                self.start_probe_file(configs, config_path, default_variables, run, files)
+
+            if shared_scope is not None:
+                self.start_scope(shared_scope, shared_probes, "probe folders", True)
+        finally:
+            run.done()
+        return run
+
+    def start_probe_file(self, configs, config_path, bindings, run, files=None):
+        """
+        Start the probes of a probe file, already checked by check_probe_configs(), in a scope of their own
+        :param files: reads files at a commit binding, see Scope
+        """
+        scope = Scope(bindings, self.get_scheduler(), run, files)
+        # Initialize Probes
+        probes = []
+        for probe_config in configs:
+            probe = Probe(probe_config, scope, self)
+            probes.append(probe)
+        self.start_scope(scope, probes, config_path)
+
+    def start_scope(self, scope, probes, source, drop_cycles=False):
+        """
+        Register the dependencies of the probes in scope, compile its plan and start it
+        :param source: where the probes were loaded from, for error messages
+        :param drop_cycles: on a dependency cycle, only leave out the probes that can't run instead of all of them,
+        e.g. for a scope shared by many probe files
+        """
+        # Get the dependencies set
+        for probe in probes:
+            probe.prep_input_dependencies()
+        # Compile the plan first, so dependency cycles are reported before anything starts
+        try:
+            scope.compile()
+        except ValueError as e:
+            if not drop_cycles:
+                logging.error("Not running probes in %s: %s", source, e)
+                self.forget_probes(probes)
+                return
+            dropped = scope.drop_cycles()
+            logging.error("Not running probes %s in %s: %s",
+                          ", ".join(probe.name or probe.headers['type'] for probe in dropped), source, e)
+            self.forget_probes(dropped)
+            scope.compile()
+        # Start all unblocked probes
+        scope.start()
+
+    def forget_probes(self, probes):
+        """
+        Drop probes that will never run from the running probes
+        """
+        self.probe_lock.acquire()
+        for probe in probes:
+            if probe in self.running_probes:
+                self.running_probes.remove(probe)
+        self.probe_lock.release()
 
 
 class Probe:
-    def __init__(self, data, scope, repo):
+    def __init__(self, data, scope, repo, namespace=None):
         """
         Initialize a probe from the JSON
+        :param namespace: the probe file's namespace when it is part of a shared scope
         """
+        self.module = modules[data['type']]
+        # Parsed once per probe, before anything is locked, so a condition that doesn't parse rejects the probe here
+        self.condition = None
+        if 'condition' in data.get('config', {}):
+            self.condition = compile_condition(data['config']['condition'])
         #Lock to enforce mutual exclusion
         self.lock = threading.Lock()
         self.lock.acquire()
-        self.module = modules[data['type']]
         self.headers = {}
         self.headers['type'] = data['type']
         self.headers['status'] = "Preparing"
@@ -530,11 +2012,16 @@ class Probe:
                 self.inputs = value
             else:
                 self.headers[key] = value
+        # Compiled once, so running the probe doesn't have to parse its inputs again
+        self.input_templates = {k: compile_template(v) for k, v in self.inputs.items()}
         self.scope = scope
         self.pids = []
         self.name = False
+        self.namespace = namespace
         if 'name' in self.headers:
             self.name = self.headers['name']
+            if namespace:
+                self.name = namespace + "." + self.name
             self.scope.add_probe(self, self.name)
         else:
             self.scope.add_probe(self)
@@ -544,6 +2031,20 @@ class Probe:
         self.headers['status'] = "Waiting"
         self.output = None
         self.error = None
+        # Full sizes of the output and errors, which can be longer than what is kept in memory
+        self.output_size = 0
+        self.error_size = 0
+        # File with the whole output, when it was too long to keep in memory
+        self.output_file = None
+        # File given to the command on stdin, and the files written for {name:file} inputs
+        self.stdin_path = None
+        self.input_files = []
+        # Set while this probe runs on behalf of identical probes in the same run
+        self.shared_result = None
+        # Key of this probe's result in the repo's result cache
+        self.cache_key = None
+        # Whether prepare() took the probe lock, which finish() releases
+        self.prepared = False
         self.lock.release()
 
     def prep_input_dependencies(self):
@@ -553,11 +2054,12 @@ class Probe:
         self.lock.acquire()
         #print("Prep grabbed probe lock")
         for item in self.inputs.values():
-            dependencies = self.scope.get_dependencies(item)
+            dependencies = self.scope.get_dependencies(item, self.namespace)
             for dependency in dependencies:
                 self.scope.register_probe_dependency(self, dependency)
 
-        dependencies = self.scope.get_dependencies(self.module.config['command'])
+        dependencies = self.scope.get_dependencies(self.module.config['command'], self.namespace)
+        dependencies += self.scope.get_dependencies(self.module.config.get('stdin', ''), self.namespace)
         for dependency in dependencies:
             self.scope.register_probe_dependency(self, dependency)
         self.lock.release()
@@ -565,58 +2067,471 @@ class Probe:
     def run(self):
         """
         Run the probe
+        :return: whether the probe ran (False if its condition wasn't met)
+        """
+        try:
+            self.materialize()
+            populated_command = self.prepare()
+            if populated_command is None:
+                self.skip()
+                return False
+            try:
+                invocation = self.get_invocation(populated_command)
+                shared = self.share(invocation)
+                if shared is not None:
+                    # An identical probe is running (or ran) in this run, and its result gets reused
+                    shared.add_done_callback(self.finish_shared)
+                    return True
+
+                if not self.load_cached(invocation):
+                    self.execute(populated_command)
+                    self.store_cached()
+            finally:
+                self.release_input_files()
+            self.publish()
+            self.finish()
+            return True
+        except BaseException as e:
+            self.fail(e)
+            raise
+
+    def execute(self, populated_command):
         """
-        if not self.evaluate_condition():
+        Run the populated command (or call the callable module) and record its output
+        """
+        if self.module.is_callable():
+            self.call(populated_command)
             return
-        self.lock.acquire()
-        self.headers['status'] = "Running"
-        self.headers['started'] = datetime.datetime.now()
-        self.scope.lock.acquire()
-        populated_config = {k: insert_named_values(v, self.scope.bindings) for k, v in self.inputs.items()}
-        quoted_config = {k: shlex.quote(v) for k, v in populated_config.items()}
-        populated_command = insert_named_values(self.module.config['command'], quoted_config)
-        populated_command = insert_named_values(populated_command, self.scope.bindings)
-        self.scope.lock.release()
-
-        # Make sure we're executing in the saad/ directory
-        os.chdir(self.repo.config['root_path'])
-        logging.debug('Current working directory: {}'.format(os.getcwd()))
-        logging.debug('Executing command: {}'.format(populated_command))
 
-        self.script = subprocess.Popen(populated_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        #Record all of the pids the probe creates, so that it can be cleaned up later.
-        self.pids = [self.script.pid]
-        if psutil.pid_exists(self.script.pid):
-            for child in psutil.Process(self.script.pid).children(recursive=True):
-                self.pids.append(child.pid)
+        # Commands run in the saad/ directory. Passed as cwd rather than changing directory, since the
+        # working directory is shared by every thread
+        logging.debug('Executing command in {}: {}'.format(self.repo.config['root_path'], populated_command))
+
+        stdin = None
+        if self.stdin_path is not None:
+            stdin = open(self.stdin_path, 'rb')
+        try:
+            self.script = subprocess.Popen(populated_command, stdin=stdin, stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE, shell=True, cwd=self.repo.config['root_path'])
+        finally:
+            if stdin is not None:
+                stdin.close()
+        self.record_pids()
+        timeout = self.get_timeout()
+        output, error = self.output_buffers()
+        # Both streams are read as the command writes them, so neither pipe fills up and blocks it
+        readers = [threading.Thread(target=read_output, args=(self.script.stdout, output), daemon=True),
+                   threading.Thread(target=read_output, args=(self.script.stderr, error), daemon=True)]
+        for reader in readers:
+            reader.start()
 
-        timeout = self.inputs.get("timeout", self.module.config.get("timeout", modules.get("defaultTimeout").config))
-        
         #Actually run the probe in the command line
         try:
             if timeout > 0:
-                self.output, self.error = self.script.communicate(timeout=timeout)
+                self.script.wait(timeout=timeout)
             else:
-                self.output, self.error = self.script.communicate()
-            self.log()
+                self.script.wait()
+            for reader in readers:
+                reader.join()
+            self.set_output(output, error)
         #Timeout handler
         except subprocess.TimeoutExpired:
             self.kill()
             self.headers['status'] = "Timed Out"
             terminate_t = time.time()
             logging.warning("Script %s timed out after %ds, attempting to terminate", self.module.name, timeout)
-            self.output, self.error = self.script.communicate()
+            self.script.wait()
+            for reader in readers:
+                reader.join()
+            self.set_output(output, error)
+
+            logging.warning("Script %s timed out, finished terminating (took %ds)", self.module.name,
+                            time.time() - terminate_t)
+
+    async def run_async(self):
+        """
+        Run the probe as an asyncio subprocess. Used by AsyncProbeEngine
+        :return: whether the probe ran (False if its condition wasn't met)
+        """
+        # Everything that can block, like checking commits out, taking the probe and scope locks, reading files
+        # for conditions, hashing for the cache and recording the probe, runs on the executor instead of the loop
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.materialize)
+            populated_command = await loop.run_in_executor(None, self.prepare)
+            if populated_command is None:
+                await loop.run_in_executor(None, self.skip)
+                return False
+            try:
+                invocation = self.get_invocation(populated_command)
+                shared = self.share(invocation)
+                if shared is not None:
+                    try:
+                        await asyncio.wrap_future(shared)
+                    except Exception:
+                        # finish_shared records the error
+                        pass
+                    await loop.run_in_executor(None, self.finish_shared, shared)
+                    return True
+
+                if not await loop.run_in_executor(None, self.load_cached, invocation):
+                    await self.execute_async(populated_command)
+                    await loop.run_in_executor(None, self.store_cached)
+            finally:
+                self.release_input_files()
+            self.publish()
+            await loop.run_in_executor(None, self.finish)
+            return True
+        except BaseException as e:
+            self.fail(e)
+            raise
+
+    async def execute_async(self, populated_command):
+        """
+        Like execute(), using an asyncio subprocess
+        """
+        if self.module.is_callable():
+            await self.call_async(populated_command)
+            return
+
+        logging.debug('Executing command: {}'.format(populated_command))
+        stdin = None
+        if self.stdin_path is not None:
+            stdin = open(self.stdin_path, 'rb')
+        try:
+            self.script = await asyncio.create_subprocess_shell(populated_command, stdin=stdin,
+                                                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                                cwd=self.repo.config['root_path'])
+        finally:
+            if stdin is not None:
+                stdin.close()
+        self.record_pids()
+        timeout = self.get_timeout()
+        output, error = self.output_buffers()
+
+        def read():
+            return asyncio.gather(read_output_async(self.script.stdout, output),
+                                  read_output_async(self.script.stderr, error), self.script.wait())
+
+        try:
+            if timeout > 0:
+                await asyncio.wait_for(read(), timeout)
+            else:
+                await read()
+            self.set_output(output, error)
+        except asyncio.TimeoutError:
+            await asyncio.get_running_loop().run_in_executor(None, self.kill)
+            self.headers['status'] = "Timed Out"
+            terminate_t = time.time()
+            logging.warning("Script %s timed out after %ds, attempting to terminate", self.module.name, timeout)
+            # Whatever was read before the timeout stays in the buffers
+            await read()
+            self.set_output(output, error)
 
             logging.warning("Script %s timed out, finished terminating (took %ds)", self.module.name,
                             time.time() - terminate_t)
 
-        # Make sure we're back in the saad/ directory
-        logging.debug('Working directory after command executed: {}'.format(os.getcwd()))
-        os.chdir(self.repo.config['root_path'])
-        logging.debug('Current working directory: {}'.format(os.getcwd()))
+    def load_cached(self, invocation):
+        """
+        Use the repo's result cache, if it has one and the module can be cached
+        :return: whether a cached result was found
+        """
+        self.cache_key = None
+        cache = self.repo.get_result_cache()
+        if cache is None or not self.module.is_cacheable():
+            return False
+        checkouts = {}
+        for name in ('HEAD', 'HEAD~1'):
+            value = self.scope.bindings.get(name)
+            # Plain folders, e.g. from iterate_over_configs(), can have changes git doesn't know about
+            path = value.get_path() if isinstance(value, LazyCheckout) else None
+            if path is not None:
+                checkouts[name] = path
+        self.cache_key = cache.get_key(self.module, invocation, self.repo.config['root_path'], checkouts)
+        if self.cache_key is None:
+            return False
+        cached = cache.get(self.cache_key)
+        if cached is None:
+            return False
+        logging.debug("Using cached result for %s probe", self.module.name)
+        self.capture_output(*cached)
+        return True
+
+    def store_cached(self):
+        """
+        Save a successful result in the result cache
+        """
+        if self.cache_key is None or self.headers['status'] != "Running" or self.error != b'':
+            return
+        if self.output_file is not None or self.output_size != len(self.output):
+            # Spilled output only lasts as long as the run
+            return
+        self.repo.get_result_cache().put(self.cache_key, self.output, self.error)
+
+    def share(self, invocation):
+        """
+        Look for an identical probe (same module, populated command and environment) in this run.
+        Modules with side effects are never shared.
+        :return: the identical probe's future result to wait on, or None if this probe has to run itself
+        """
+        self.shared_result = None
+        if self.scope.run is None or self.module.has_side_effects():
+            return None
+        if isinstance(invocation, dict):
+            invocation = json.dumps(invocation, sort_keys=True)
+        key = (self.module.name, self.repo.config['root_path'], self.get_timeout(), invocation)
+        future, leader = self.scope.run.share(key)
+        if leader:
+            self.shared_result = future
+            return None
+        return future
+
+    def publish(self, error=None):
+        """
+        Pass this probe's result on to the identical probes waiting on it
+        """
+        if self.shared_result is None or self.shared_result.done():
+            return
+        if error is not None:
+            self.shared_result.set_exception(error)
+        else:
+            self.shared_result.set_result((self.output, self.error, self.headers['status'], self.output_size,
+                                           self.error_size, self.output_file))
+
+    def finish_shared(self, future):
+        """
+        Finish with the result of the identical probe this one waited on
+        """
+        try:
+            self.output, self.error, status, self.output_size, self.error_size, self.output_file = future.result()
+            if status == "Timed Out":
+                self.headers['status'] = status
+        except Exception as e:
+            self.capture_output(b'', str(e).encode('utf-8'))
+        logging.debug("Reusing the result of an identical %s probe", self.module.name)
+        self.finish()
+
+    async def call_async(self, kwargs):
+        """
+        Call a callable module on the default executor, so it doesn't block the event loop
+        """
+        call = asyncio.get_running_loop().run_in_executor(None, self.call, kwargs)
+        if self.module.runs_in_worker():
+            # The worker pool enforces the timeout itself
+            await call
+            return
+        timeout = self.get_timeout()
+        try:
+            if timeout > 0:
+                await asyncio.wait_for(call, timeout)
+            else:
+                await call
+        except asyncio.TimeoutError:
+            # The call keeps running in its thread, but the probe stops waiting on it
+            self.headers['status'] = "Timed Out"
+            logging.warning("Callable %s timed out after %ds", self.module.name, timeout)
+            self.capture_output(b'', b'')
+
+    def call(self, kwargs):
+        """
+        Run a callable module, in a worker process if the module sets "worker".
+        Timeouts are only enforced for worker processes
+        """
+        if self.module.runs_in_worker():
+            timeout = self.get_timeout()
+            output, error, timed_out = self.repo.get_worker_pool().call(self.module.config['callable'], kwargs,
+                                                                        timeout)
+            self.capture_output(output, error)
+            if timed_out:
+                self.headers['status'] = "Timed Out"
+                logging.warning("Callable %s timed out after %ds, worker killed", self.module.name, timeout)
+        else:
+            self.capture_output(*call_module(self.module.config['callable'], kwargs))
+
+    def output_buffers(self):
+        """
+        Make the buffers for reading the probe's output and errors, limited to OutputMemoryLimit KB in memory.
+        Only the output is spilled to a file, since only it is passed on to other probes
+        """
+        limit = int(self.repo.get_server_setting('outputmemorylimit', DEFAULT_OUTPUT_MEMORY_LIMIT)) * 1024
+        return OutputBuffer(limit, self.get_output_folder()), OutputBuffer(limit, spill=False)
+
+    def get_output_folder(self):
+        """
+        Get the folder set with OutputFolder for spilled output and input files
+        :return: None to use the system temp directory
+        """
+        folder = self.repo.get_server_setting('outputfolder')
+        if folder is not None:
+            folder = os.path.join(self.repo.config['root_path'], folder)
+        return folder
+
+    def input_file(self, value):
+        """
+        Get the path of a file holding value, for {name:file} placeholders and stdin.
+        Spilled output already is a file, so its path is used as is
+        """
+        if isinstance(value, OutputFile):
+            return value
+        path = acquire_input_file(value, self.get_output_folder())
+        self.input_files.append(path)
+        return path
+
+    def release_input_files(self):
+        for path in self.input_files:
+            release_input_file(path)
+        self.input_files = []
+
+    def get_invocation(self, populated_command):
+        """
+        Get what identifies the probe's invocation for sharing and caching results: the populated command,
+        plus the file given on stdin, whose contents the result cache hashes like any other path
+        """
+        if self.stdin_path is None:
+            return populated_command
+        return populated_command + ' < ' + shlex.quote(self.stdin_path)
+
+    def set_output(self, output, error):
+        """
+        Take the probe's result from its OutputBuffers. Spilled output is deleted once the run finishes, or by
+        finish() for probes that aren't part of a run
+        """
+        output.close()
+        error.close()
+        self.output = output.getvalue()
+        self.error = error.getvalue()
+        self.output_size = output.size
+        self.error_size = error.size
+        self.output_file = output.path
+        if self.output_file is not None:
+            logging.debug("Output of %s probe is %d bytes, spilled to %s", self.module.name, self.output_size,
+                          self.output_file)
+            if self.scope.run is not None:
+                self.scope.run.when_finished(lambda: remove_output_file(output.path))
+
+    def capture_output(self, output, error):
+        """
+        Like set_output, for output that was produced all at once, e.g. by a callable module
+        """
+        buffers = self.output_buffers()
+        buffers[0].write(output)
+        buffers[1].write(error)
+        self.set_output(*buffers)
+
+    def get_templates(self):
+        """
+        Get the compiled templates filled in when the probe runs: its inputs and its module's templates
+        """
+        templates = list(self.input_templates.values()) + [compile_template(self.module.config.get('command', ''))]
+        templates += [compile_template(v) for v in self.module.config.get('kwargs', {}).values()]
+        if 'stdin' in self.module.config:
+            templates.append(compile_template(self.module.config['stdin']))
+        return templates
+
+    def materialize(self):
+        """
+        Check out the commits the probe uses, like {HEAD}, in parallel if there are several.
+        Skipped probes don't check anything out
+        """
+        if not self.watches_changed_paths():
+            return
+        materialize_checkouts(self.scope.lazy_checkouts(self.get_templates(), self.namespace))
+
+    def prepare(self):
+        """
+        Check the condition, mark the probe as running and fill in its inputs.
+        Holds the probe lock until finish() is called.
+        :return: the command to run, or the keyword arguments for a callable module.
+        None if the probe shouldn't run
+        """
+        if not self.watches_changed_paths() or not self.evaluate_condition():
+            return None
+        self.lock.acquire()
+        self.prepared = True
+        self.headers['status'] = "Running"
+        self.headers['started'] = datetime.datetime.now()
+        templates = self.get_templates()
+        # Only the values the templates use are copied, and rendering happens outside of the scope lock
+        names = set()
+        for template in templates:
+            names.update(template.names)
+        names.update([name[:-len(FILE_SUFFIX)] for name in names if name.endswith(FILE_SUFFIX)])
+        bindings = self.scope.values_for(names, self.namespace)
+        bindings.update(self.scope.file_bindings(templates))
+        # {name:file} is a file at a commit when name is a commit, and otherwise the value of name written to a file
+        for name in names:
+            value = bindings.get(name[:-len(FILE_SUFFIX)])
+            if name.endswith(FILE_SUFFIX) and name not in bindings and value is not None and \
+                    not isinstance(value, LazyCheckout):
+                bindings[name] = self.input_file(value)
+        populated_config = {}
+        for k, template in self.input_templates.items():
+            if isinstance(bindings.get(template.placeholder), OutputFile):
+                # Still recognized as spilled output by the module's "stdin" and {name:file}
+                populated_config[k] = bindings[template.placeholder]
+            else:
+                populated_config[k] = template.render(bindings)
+        # The module's templates can ask for one of the probe's inputs as a file too, like {message:file}
+        input_files = {}
+        for name in names:
+            if name.endswith(FILE_SUFFIX) and name[:-len(FILE_SUFFIX)] in populated_config:
+                input_files[name] = self.input_file(populated_config[name[:-len(FILE_SUFFIX)]])
+        if self.module.is_callable():
+            return self.module.get_kwargs(populated_config, merge_two_dicts(bindings, input_files))
+        self.stdin_path = None
+        if 'stdin' in self.module.config:
+            self.stdin_path = self.get_stdin(merge_two_dicts(bindings, populated_config))
+        quoted_config = {k: shlex.quote(v) for k, v in merge_two_dicts(populated_config, input_files).items()}
+        return compile_template(self.module.config['command']).render(merge_two_dicts(bindings, quoted_config))
+
+    def get_stdin(self, values):
+        """
+        Fill in the module's "stdin" template and write it to a file for the command to read.
+        When the template is just a placeholder for spilled output, that file is read directly
+        """
+        template = compile_template(self.module.config['stdin'])
+        if isinstance(values.get(template.placeholder), OutputFile):
+            return values[template.placeholder]
+        return self.input_file(template.render(values))
+
+    def record_pids(self):
+        """
+        Record all of the pids the probe creates, so that it can be cleaned up later.
+        """
+        self.pids = [self.script.pid]
+        try:
+            for child in psutil.Process(self.script.pid).children(recursive=True):
+                self.pids.append(child.pid)
+        except psutil.NoSuchProcess:
+            # Already exited
+            pass
+
+    def get_timeout(self):
+        return self.inputs.get("timeout", self.module.config.get("timeout", modules.get("defaultTimeout").config))
+
+    def skip(self):
+        """
+        Mark the probe as skipped, because its condition wasn't met, none of its paths changed or it depends on
+        a skipped probe, and skip the probes depending on it
+        """
+        self.headers['status'] = "Skipped"
+        self.headers['finished'] = datetime.datetime.now()
+        self.repo.probe_lock.acquire()
+        if self in self.repo.running_probes:
+            self.repo.running_probes.remove(self)
+        self.repo.probe_lock.release()
+        self.scope.skip_dependents(self)
 
-        self.output = self.output.decode('utf-8')
-        self.error = self.error.decode('utf-8')
+    def finish(self):
+        """
+        Decode the output, pass the result on to the scope, record the probe and release the probe lock taken
+        by prepare()
+        """
+        # Kept as the status of probes that were stopped, whatever they output
+        stopped_status = self.headers['status'] if self.headers['status'] in ("Timed Out", "Terminated") else None
+        # Truncated output can end partway through a character
+        self.output = self.output.decode('utf-8', errors='replace')
+        self.error = self.error.decode('utf-8', errors='replace')
         # TODO: handle errors and return values better
         if self.error != '' and self.error is not None:
             self.headers['status'] = "Error"
@@ -627,22 +2542,40 @@ class Probe:
             self.headers['status'] = "Finished"
             print(self.output)
             if self.name:
-                self.scope.update_with_result(self.name, self.output)
+                # Output too long to keep in memory is passed on as the path of the file it was spilled to,
+                # as long as there is a run to delete it once it's done
+                spilled = self.output_file is not None and self.scope.run is not None
+                self.scope.update_with_result(self.name, OutputFile(self.output_file) if spilled else self.output)
+        if self.output_file is not None and self.scope.run is None:
+            # Nothing else would ever delete it, e.g. for probes started from /run/module
+            remove_output_file(self.output_file)
+        if stopped_status is not None:
+            self.headers['status'] = stopped_status
         self.headers['finished'] = datetime.datetime.now()
+        self.log()
         self.repo.probe_lock.acquire()
-        self.repo.running_probes.remove(self)
+        if self in self.repo.running_probes:
+            self.repo.running_probes.remove(self)
         self.repo.probe_lock.release()
+        self.prepared = False
         self.lock.release()
 
+    def fail(self, error):
+        """
+        Finish a probe whose run raised, with the error as its errors, so the identical probes and the probes
+        depending on it don't wait forever and the probe lock is released
+        """
+        self.publish(error)
+        if not self.prepared:
+            self.lock.acquire()
+            self.prepared = True
+        self.capture_output(b'', str(error).encode('utf-8'))
+        self.finish()
+
     def log(self):
         """
-        Record the probe in the database
+        Record the probe in the database. The record is written in the background by probe_logger
         """
-        global probes_db_path
-        probes_db = connect_database(probe_db_path)
-        if probes_db is None:
-            return
-        cursor = probes_db.cursor()
         tempname = ''
         if self.name:
             tempname = self.name
@@ -653,16 +2586,15 @@ class Probe:
             times[1] = int(self.headers['started'].strftime("%s"))
         if self.headers['finished'] is not None:
             times[2] = int(self.headers['finished'].strftime("%s"))
-        cursor.execute('INSERT INTO probes (type, name, create_time, start_time, end_time) VALUES (?, ?, ?, ?, ?);',
-                       (self.headers['type'], tempname, times[0], times[1], times[2],))
-
-        probe_id = cursor.lastrowid
-        for probe_input, input_val in self.inputs.items():
-            cursor.execute('INSERT INTO probe_inputs VALUES (?, ?, ?);', (probe_id, probe_input, input_val,))
-
-        cursor.execute('INSERT INTO probe_outputs VALUES (?, ?, ?);', (probe_id, self.error, self.output,))
-        probes_db.commit()
-        probes_db.close()
+        duration = None
+        if self.headers['started'] is not None and self.headers['finished'] is not None:
+            duration = (self.headers['finished'] - self.headers['started']).total_seconds()
+        run_id = self.scope.run.id if self.scope.run is not None else None
+        probe_logger.log({'type': self.headers['type'], 'name': tempname, 'run_id': run_id, 'repo': self.repo.name,
+                          'status': self.headers['status'], 'create_time': times[0], 'start_time': times[1],
+                          'end_time': times[2], 'duration': duration, 'inputs': list(self.inputs.items()),
+                          'errors': self.error, 'output': self.output, 'error_size': self.error_size,
+                          'output_size': self.output_size})
 
     def kill(self):
         """
@@ -673,24 +2605,34 @@ class Probe:
                 psutil.Process(pid).kill()
         self.headers['status'] = "Terminated"
         self.headers['finished'] = datetime.datetime.now()
-        self.log()
         return
 
+    def watches_changed_paths(self):
+        """
+        Check the probe's "paths" filter, a glob pattern or list of them, against the paths changed in the run.
+        Probes without a filter, or in runs where the changes aren't known, always run
+        """
+        if 'paths' not in self.headers or self.scope.run is None or self.scope.run.changed_paths is None:
+            return True
+        patterns = self.headers['paths']
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        for path in self.scope.run.changed_paths:
+            for pattern in patterns:
+                if fnmatch.fnmatchcase(path, pattern):
+                    return True
+        logging.debug("Skipping %s probe, none of its paths changed", self.module.name)
+        return False
+
     def evaluate_condition(self):
         """
         Check that the condition for running the probe is met
         """
-        self.lock.acquire()
-        if 'condition' not in self.inputs:
-            self.lock.release()
+        if self.condition is None:
             return True
-        condition = self.inputs['condition']
-        self.lock.release()
-        self.scope.lock.acquire()
-        populated_condition = insert_named_values(condition, self.scope.bindings)
-        self.scope.lock.release()
-
-        return eval(populated_condition)
+        bindings = self.scope.values_for(self.condition.names, self.namespace)
+        bindings.update(self.scope.file_bindings([self.condition]))
+        return self.condition.evaluate(bindings)
 
     def __str__(self):
         return str({'headers': self.headers, 'inputs': self.inputs})
@@ -709,12 +2651,46 @@ class Module:
         Start a probe with the given inputs.
         """
         p = Probe({"type": self.name, "config": probe_inputs}, scope, repo)
-        thread = threading.Thread(target=p.run, args=())
-        thread.start()
+        repo.get_scheduler().submit(p, scope.run)
 
     def get_inputs(self):
         return get_named_values(self.config)
 
+    def is_callable(self):
+        """
+        Whether the module is a Python function called in-process instead of a shell command
+        """
+        return 'callable' in self.config
+
+    def has_side_effects(self):
+        """
+        Whether probes of this module do something besides producing output (e.g. post to Slack),
+        so identical probes still each have to run
+        """
+        return bool(self.config.get('sideEffects', False))
+
+    def is_cacheable(self):
+        """
+        Whether results of this module can be reused from the result cache. Modules opt out with "cache": false
+        """
+        return not self.has_side_effects() and bool(self.config.get('cache', True))
+
+    def runs_in_worker(self):
+        """
+        Whether a callable module runs on the worker pool instead of in the server process
+        """
+        return self.is_callable() and bool(self.config.get('worker', False))
+
+    def get_kwargs(self, populated_config, bindings):
+        """
+        Get the keyword arguments for a callable module.
+        Modules can map argument names to templates with "kwargs", otherwise the probe inputs are passed as is
+        """
+        if 'kwargs' in self.config:
+            values = merge_two_dicts(bindings, populated_config)
+            return {k: compile_template(v).render(values) for k, v in self.config['kwargs'].items()}
+        return {k: v for k, v in populated_config.items() if k not in PROBE_CONTROL_INPUTS}
+
     def __str__(self):
         return str(self.config)
 
@@ -734,7 +2710,13 @@ def load_modules():
 
 
 def iterate_over_configs(current_commit_dir, previous_commit_dir):
+    """
+    Run every probe file in current_commit_dir without a server
+    :return: the ProbeRun tracking the started probes
+    """
     path = os.path.join(current_commit_dir, 'probe_configs')
+    repo = Repo("", "", os.path.dirname(os.path.abspath(__file__)))
+    run = ProbeRun()
 
     # Default variables that can be accessed in module/monitoring configs
     default_variables = {
@@ -742,31 +2724,22 @@ def iterate_over_configs(current_commit_dir, previous_commit_dir):
         "HEAD~1": previous_commit_dir
     }
     # Loop over all files
-    for configs in all_json_in_dir(path):
-        scope = Scope(default_variables)
-        # Initialize Probes
-        probes = []
-        for probe_config in configs:
-            probe = Probe(probe_config, scope, Repo("", "", os.path.dirname(os.path.abspath(__file__))))
-            probes.append(probe)
-        # Get the dependencies set
-        for probe in probes:
-            probe.prep_input_dependencies()
-        # Run probes
-        scope.lock.acquire()
-        data = scope.blocking_counts
-        for probe_name in data.keys():
-            if data[probe_name] == 0:
-                thread = threading.Thread(target=scope.probes[probe_name].run, args=())
-                thread.start()
-                #scope.probes[probe_name].run()
-        scope.lock.release()
+    for config_path, configs in all_json_files_in_dir(path):
+        try:
+            check_probe_configs(configs)
+        except ValueError as e:
+            logging.error("Not running probes in %s: %s", config_path, e)
+            continue
+        repo.start_probe_file(configs, config_path, default_variables, run)
+    return run
 
 
 probe_db_path = os.path.dirname(os.path.abspath(__file__)) + "/probeDatabase.sql"
 probes_db = connect_database(probe_db_path)
 init_database(probes_db)
+# Writes probe records in batches. Flushed when the server shuts down
+probe_logger = ProbeLogger(probe_db_path)
 modules = load_modules()
 
 if __name__ == "__main__":
-    iterate_over_configs(os.path.dirname(os.path.abspath(__file__)), os.path.dirname(os.path.abspath(__file__)))
+    iterate_over_configs(os.path.dirname(os.path.abspath(__file__)), os.path.dirname(os.path.abspath(__file__))).wait()
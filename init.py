@@ -2,6 +2,7 @@
 
 import argparse
 import hashlib
+import html
 import http.server
 import json
 import logging
@@ -18,7 +19,10 @@ from http import HTTPStatus
 from os.path import basename
 from typing import Final
 
+import checkouts
 import core
+import probelog
+import workers
 
 DEFAULT_PORT: Final = 8080
 ALLOWED_REPO_URLS = {"https://github.com/skimberk/saad.git",
@@ -35,39 +39,10 @@ parser.add_argument('--previous_commit', type=str)
 parser.add_argument('--current_commit', type=str)
 parser.add_argument('--clone_url', type=str)
 parser.add_argument('--master_config', type=str)
-args = parser.parse_args()
-
-logging.basicConfig()
-logging.getLogger().setLevel(logging.DEBUG)  # Print all logs
-
-serverRepo = core.Repo(SERVER_REPO_URL, 'Server', os.path.dirname(os.path.abspath(__file__)))
-# Make sure we're in saad/ directory (important when running as a service)
-os.chdir(serverRepo.config['root_path'])
-
-if (args.master_config is not None) and os.path.isfile(args.master_config):
-    serverRepo.load_config_recursive(args.master_config)
-elif os.path.isfile("SAAD_config.cfg"):
-    logging.info("Invalid master config file, running on default")
-    serverRepo.load_config_recursive("SAAD_config.cfg")
-
-else:
-    logging.info("Can't find a master config, shutting down")
-    # TODO: Shut down
-
-if (args.clone_url is not None) and (args.clone_url not in ALLOWED_REPO_URLS):
-    logging.info("Adding command line URL to ALLOWED_URLs: " + args.clone_url)
-    ALLOWED_REPO_URLS.add(args.clone_url)
 
+# Set up when the server starts (see the bottom of the file)
+serverRepo = None
 httpd = None
-serverRepo.reload_all_modules()
-print(serverRepo.config)
-if 'ALLOWED_REPO_URLS' in serverRepo.config:
-    for repo in serverRepo.config['ALLOWED_REPO_URLS']:
-        core.Repo(serverRepo.config['ALLOWED_REPO_URLS'][repo], repo, serverRepo.config['root_path'], serverRepo)
-for repo in serverRepo.child_repos.values():
-    repo.load_config_recursive("", 'current', True)
-for repo in serverRepo.child_repos.values():
-    repo.reload_all_modules()
 
 
 def update_self(server, script_args):
@@ -77,15 +52,18 @@ def update_self(server, script_args):
     server.shutdown()
     server.server_close()
 
-    print("making sure we are in current directory...")
-    os.chdir(serverRepo.config['root_path'])
-    print("current directory:", os.getcwd())
+    print("waiting for queued probes...")
+    core.shutdown_schedulers()
+    workers.shutdown_pools()
+    checkouts.close_managers()
+    core.probe_logger.close()
 
-    print("pulling new code from git...")
-    os.system("git pull")
+    print("pulling new code from git into " + serverRepo.config['root_path'] + "...")
+    subprocess.call(["git", "pull"], cwd=serverRepo.config['root_path'])
 
     print("installing dependencies")
-    os.system("python3 -m pip install --user -r requirements.txt")
+    subprocess.call(["python3", "-m", "pip", "install", "--user", "-r", "requirements.txt"],
+                    cwd=serverRepo.config['root_path'])
 
     print("starting new code...")
     os.execv(script_args[0], script_args)
@@ -112,6 +90,13 @@ def run_on_git(clone_url, current_commit, previous_commit):
     serverRepo.child_repos[repo_name].run_all_probes(current_commit, previous_commit)
 
 
+def web_file(name):
+    """
+    Get the path of a file in the WEB_ROOT folder
+    """
+    return os.path.join(serverRepo.config['root_path'], serverRepo.config['web_root'], name)
+
+
 def get_logs():
     command = "journalctl -n 500 --no-pager -u saad_python_service.service"
     script = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
@@ -161,6 +146,10 @@ class Handler(http.server.BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(message.encode())
 
+    def write_chunk(self, data):
+        # Write one chunk of a response sent with Transfer-Encoding: chunked. An empty chunk ends the response
+        self.wfile.write(("%x\r\n" % len(data)).encode() + data + b"\r\n")
+
     def do_GET(self):
         """
         Handle GET requests
@@ -170,8 +159,6 @@ class Handler(http.server.BaseHTTPRequestHandler):
         url_path = urllib.parse.urlparse(self.path).path
         get_args = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
         #print(urllib.parse.urlparse(self.path))
-        os.chdir(serverRepo.config['root_path'])
-        logging.debug('Current working directory: {}'.format(os.getcwd()))
 
         if url_path == "/logs":
             if self.handle_auth():
@@ -194,6 +181,70 @@ class Handler(http.server.BaseHTTPRequestHandler):
 
                 self.wfile.write(json.dumps(data).encode())
             return
+        elif url_path == "/api/checkouts":
+            if self.handle_auth():
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                data = {}
+                for name, repo in serverRepo.child_repos.items():
+                    if repo.checkouts is not None:
+                        data[name] = repo.checkouts.stats()
+
+                self.wfile.write(json.dumps(data).encode())
+            return
+        elif url_path == "/api/probelogs":
+            if self.handle_auth():
+                # Filters, plus before from the previous page's next to get the page after it
+                query = {name: get_args[name][0] for name in ('repo', 'module', 'status') if name in get_args}
+                try:
+                    for name in ('since', 'until', 'before', 'limit'):
+                        if name in get_args:
+                            query[name] = int(get_args[name][0])
+                except ValueError:
+                    return self.write_json_problem_details(HTTPStatus.BAD_REQUEST,
+                                                           "{\"title\": \"Invalid query\","
+                                                           "\"detail\": \"since, until, before and limit must be "
+                                                           "integers\"}")
+                query['limit'] = max(1, min(query.get('limit', probelog.DEFAULT_PAGE_SIZE), probelog.MAX_PAGE_SIZE))
+                # Clients that cache outputs by hash can leave them out and get the ones they don't have from /api/blobs
+                query['outputs'] = get_args.get('outputs', ['true'])[0].lower() != 'false'
+                db = core.connect_database(core.probe_db_path)
+                try:
+                    probes, next_page = probelog.query_probes(db, **query)
+                finally:
+                    db.close()
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({'probes': probes, 'next': next_page}).encode())
+            return
+        elif url_path == "/api/blobs":
+            if self.handle_auth():
+                content_hash = get_args.get('hash', [''])[0]
+                # A blob never changes, so its hash is its ETag and it can be cached for good
+                etag = '"' + content_hash + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(HTTPStatus.NOT_MODIFIED)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                db = core.connect_database(core.probe_db_path)
+                try:
+                    content = probelog.read_blob(db, content_hash)
+                finally:
+                    db.close()
+                if content is None:
+                    return self.write_json_problem_details(HTTPStatus.NOT_FOUND,
+                                                           "{\"title\": \"Not found\","
+                                                           "\"detail\": \"No output is stored with that hash\"}")
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'private, max-age=31536000, immutable')
+                self.end_headers()
+                self.wfile.write(content.encode('utf-8'))
+            return
         elif url_path == "/modules":
             if self.handle_auth():
                 print(vars(self))
@@ -217,7 +268,7 @@ class Handler(http.server.BaseHTTPRequestHandler):
                     outhtml += i
 
                 try:
-                    with open(serverRepo.config['web_root'] + "/modules.html", 'rb') as file:
+                    with open(web_file("modules.html"), 'rb') as file:
                         self.send_response(HTTPStatus.OK)
                         self.send_header('Content-Type', 'text/html')
                         self.end_headers()
@@ -237,7 +288,6 @@ class Handler(http.server.BaseHTTPRequestHandler):
                     repo = serverRepo.child_repos[get_args['repo'][0]]
                 if repo:
                     probes = repo.load_probe_json()
-                    os.chdir(serverRepo.config['root_path'])
                     self.send_response(HTTPStatus.OK)
                     self.send_header('Content-Type', 'application/json')
                     self.end_headers()
@@ -258,11 +308,10 @@ class Handler(http.server.BaseHTTPRequestHandler):
                     repo = serverRepo.child_repos[get_args['repo'][0]]
                 if repo:
                     probes = repo.load_probe_json()
-                    os.chdir(serverRepo.config['root_path'])
                     datajson = json.dumps(probes, indent=4)
 
                     try:
-                        with open(serverRepo.config['web_root'] + "/probes.html", 'rb') as file:
+                        with open(web_file("probes.html"), 'rb') as file:
                             self.send_response(HTTPStatus.OK)
                             self.send_header('Content-Type', 'text/html')
                             self.end_headers()
@@ -310,7 +359,7 @@ class Handler(http.server.BaseHTTPRequestHandler):
                 datastring += "</ul>"
 
                 try:
-                    with open(serverRepo.config['web_root'] + "/running.html", 'rb') as file:
+                    with open(web_file("running.html"), 'rb') as file:
                         self.send_response(HTTPStatus.OK)
                         self.send_header('Content-Type', 'text/html')
                         self.end_headers()
@@ -325,46 +374,54 @@ class Handler(http.server.BaseHTTPRequestHandler):
             return
         elif url_path == "/probelogs":
             if self.handle_auth():
-                db_path = core.probe_db_path
-                db = core.connect_database(db_path)
-                cursor = db.cursor()
-                probe_list_html = ""
-                #Display probe data. Note that probes can have arbitrarily many inputs (and outputs on the database end)
-                for probe_id in cursor.execute("SELECT id FROM probes"):
-                    probe_list_html += '<li><ul style="display:inline;">'
-                    cursor2 = db.cursor()
-                    temp = cursor2.execute("SELECT * FROM probes WHERE id=?", (probe_id[0],))
-                    for item in cursor2.execute("SELECT * FROM probes WHERE id=?", (probe_id[0],)):
-                        for thing in item:
-                            if not isinstance(thing, str):
-                                probe_list_html += "<li style='display:inline;'> " + str(thing) + "</li>"
-                            else:
-                                probe_list_html += "<li style='display:inline;'> " + thing + "</li>"
-                    for item in cursor2.execute("SELECT * FROM probe_inputs WHERE probe_id=?", (probe_id[0],)):
-                        for thing in item[1:]:
-                            if not isinstance(thing, str):
-                                probe_list_html += "<li style='display:inline;'> " + str(thing) + "</li>"
-                            else:
-                                probe_list_html += "<li style='display:inline;'> " + thing + "</li>"
-                    for item in cursor2.execute("SELECT * FROM probe_outputs WHERE probe_id=?", (probe_id[0],)):
-                        for thing in item[1:]:
-                            if not isinstance(thing, str):
-                                probe_list_html += "<li style='display:inline;'> " + str(thing) + "</li>"
-                            else:
-                                probe_list_html += "<li style='display:inline;'> " + thing + "</li>"
-                    probe_list_html += "</ul></li>"
-                db.close()
-                with open(serverRepo.config['web_root'] + "/probelogs.html", 'rb') as file:
-                    self.send_response(HTTPStatus.OK)
-                    self.send_header('Content-Type', 'text/html')
+                try:
+                    limit = int(get_args['limit'][0]) if 'limit' in get_args else probelog.DEFAULT_PAGE_SIZE
+                    before = int(get_args['before'][0]) if 'before' in get_args else None
+                except ValueError:
+                    self.send_response(HTTPStatus.BAD_REQUEST)
                     self.end_headers()
-
-                    self.wfile.write(file.read()
-                                     .replace("{{probes}}".encode(), probe_list_html.encode()))
+                    return
+                limit = max(1, min(limit, probelog.MAX_PAGE_SIZE))
+                with open(web_file("probelogs.html"), 'rb') as file:
+                    head, tail = file.read().split("{{probes}}".encode(), 1)
+                # Chunked transfer encoding needs HTTP/1.1. The connection is closed afterwards all the same
+                self.protocol_version = "HTTP/1.1"
+                self.close_connection = True
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.write_chunk(head)
+                db = core.connect_database(core.probe_db_path)
+                count = 0
+                last_id = None
+                try:
+                    #Display probe data. Note that probes can have arbitrarily many inputs
+                    for probe, inputs, output in probelog.iterate_probes(db, before, limit):
+                        count += 1
+                        last_id = probe[0]
+                        values = list(probe)
+                        for name, value in inputs:
+                            values += [name, value]
+                        values += list(output)
+                        probe_html = '<li><ul style="display:inline;">'
+                        for thing in values:
+                            probe_html += "<li style='display:inline;'> " + html.escape(str(thing)) + "</li>"
+                        probe_html += "</ul></li>\n"
+                        self.write_chunk(probe_html.encode())
+                finally:
+                    db.close()
+                next_html = ""
+                if count == limit:
+                    next_html = '<a href="/probelogs?limit=' + str(limit) + '&before=' + str(last_id) + '">Older probes</a>'
+                self.write_chunk(tail.replace("{{next}}".encode(), next_html.encode()))
+                self.write_chunk(b"")
+            return
 
         elif url_path == "/":
             try:
-                with open(serverRepo.config['web_root'] + "/root.html", 'rb') as file:
+                with open(web_file("root.html"), 'rb') as file:
                     self.send_response(HTTPStatus.OK)
                     self.send_header('Content-Type', 'text/html')
                     self.end_headers()
@@ -440,7 +497,7 @@ class Handler(http.server.BaseHTTPRequestHandler):
                     self.send_header('Content-Type', 'text/plain')
                     self.end_headers()
                     self.wfile.write("Running...\n".encode())
-                    serverRepo.child_repos[repo_name].commits.pop('current', None)
+                    serverRepo.child_repos[repo_name].fetch()
                     return serverRepo.child_repos[repo_name].run_all_probes(current_commit, previous_commit)
                 else:
                     return self.write_json_problem_details(HTTPStatus.UNPROCESSABLE_ENTITY,
@@ -474,12 +531,49 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     allow_reuse_address = True
 
 
-httpd = ThreadedTCPServer(("", args.port), Handler)
+# Only start the server when run directly. Worker processes re-import the main module, and must not
+# start a second server
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)  # Print all logs
 
-if args.previous_commit and args.current_commit and args.clone_url:
-    print("Running on self", args.clone_url, args.current_commit, args.previous_commit)
-    func_args = (args.clone_url, args.current_commit, args.previous_commit,)
-    threading.Thread(target=run_on_git, args=func_args).start()
+    serverRepo = core.Repo(SERVER_REPO_URL, 'Server', os.path.dirname(os.path.abspath(__file__)))
+    # Make sure we're in saad/ directory (important when running as a service)
+    os.chdir(serverRepo.config['root_path'])
 
-print("server at port", args.port)
-httpd.serve_forever()
+    if (args.master_config is not None) and os.path.isfile(args.master_config):
+        serverRepo.load_config_recursive(args.master_config)
+    elif os.path.isfile("SAAD_config.cfg"):
+        logging.info("Invalid master config file, running on default")
+        serverRepo.load_config_recursive("SAAD_config.cfg")
+
+    else:
+        logging.info("Can't find a master config, shutting down")
+        # TODO: Shut down
+
+    if (args.clone_url is not None) and (args.clone_url not in ALLOWED_REPO_URLS):
+        logging.info("Adding command line URL to ALLOWED_URLs: " + args.clone_url)
+        ALLOWED_REPO_URLS.add(args.clone_url)
+
+    serverRepo.reload_all_modules()
+    core.configure_probe_logger(serverRepo)
+    print(serverRepo.config)
+    if 'ALLOWED_REPO_URLS' in serverRepo.config:
+        for repo in serverRepo.config['ALLOWED_REPO_URLS']:
+            core.Repo(serverRepo.config['ALLOWED_REPO_URLS'][repo], repo, serverRepo.config['root_path'], serverRepo)
+    for repo in serverRepo.child_repos.values():
+        repo.load_config_recursive("", 'current', True)
+    for repo in serverRepo.child_repos.values():
+        repo.reload_all_modules()
+
+    httpd = ThreadedTCPServer(("", args.port), Handler)
+
+    if args.previous_commit and args.current_commit and args.clone_url:
+        print("Running on self", args.clone_url, args.current_commit, args.previous_commit)
+        func_args = (args.clone_url, args.current_commit, args.previous_commit,)
+        threading.Thread(target=run_on_git, args=func_args).start()
+
+    print("server at port", args.port)
+    httpd.serve_forever()
@@ -0,0 +1,599 @@
+"""
+Recording the probes that ran in the probe database. Probes hand their records to a ProbeLogger, whose writer
+thread inserts them in batches over one long-lived connection in WAL mode. Probes don't wait on a commit each,
+and readers like the /probelogs page don't block the writer.
+The schema is versioned with PRAGMA user_version, and migrate_database brings older databases up to date.
+Outputs are stored once per content in a table of blobs keyed by their hash, compressed if they are long,
+and a compactor thread deletes the history the retention settings don't keep.
+"""
+import atexit
+import hashlib
+import itertools
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    # Optional, for ProbeLogCompression = zstd
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Longest time in seconds a record waits before it is written...
+DEFAULT_LOG_FLUSH_INTERVAL = 1.0
+# ...and the most records written in one transaction
+DEFAULT_LOG_BATCH_SIZE = 1000
+# Probes per page of query_probes, unless the caller asks for another amount up to MAX_PAGE_SIZE
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Outputs and errors are compressed once they are this many bytes
+COMPRESSION_THRESHOLD = 1024
+# Seconds between runs of the compactor, unless ProbeLogCompactInterval is set
+DEFAULT_COMPACT_INTERVAL = 3600
+# Probes deleted in one transaction by the compactor, so the writer isn't held up for long
+COMPACT_BATCH_SIZE = 1000
+
+
+# A probe's stored errors and output with how each is compressed. They are in blobs, or inline in probe_outputs
+# for rows from before blobs
+STORED_OUTPUT_COLUMNS = 'CASE WHEN o.errors_hash IS NULL THEN o.errors ELSE be.data END, ' \
+                        'CASE WHEN o.errors_hash IS NULL THEN o.compression ELSE be.compression END, ' \
+                        'CASE WHEN o.output_hash IS NULL THEN o.output ELSE bo.data END, ' \
+                        'CASE WHEN o.output_hash IS NULL THEN o.compression ELSE bo.compression END'
+BLOB_JOINS = ' LEFT JOIN blobs be ON be.hash = o.errors_hash LEFT JOIN blobs bo ON bo.hash = o.output_hash'
+
+
+def blob_content(value):
+    """
+    Get errors or output as the bytes stored in a blob
+    :return: (hash, content), or (None, None) for a missing value
+    """
+    if value is None:
+        return None, None
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return hashlib.sha256(value).hexdigest(), value
+
+
+def compress(value, compression):
+    """
+    Compress errors or output for storing, if they are long enough to be worth it
+    :param compression: 'zlib', 'zstd' or None
+    :return: (value, compression) to store, with compression None if the value was left as it is
+    """
+    if compression is None or len(value) < COMPRESSION_THRESHOLD:
+        return value, None
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(value), compression
+    return zlib.compress(value), compression
+
+
+def decompress(value, compression):
+    """
+    Get stored errors or output back as text
+    """
+    if value is None or compression is None:
+        return text(value)
+    if compression == 'zstd':
+        if zstandard is None:
+            return "[zstd compressed, install the zstandard package to read it]"
+        return zstandard.ZstdDecompressor().decompress(value).decode('utf-8', errors='replace')
+    return zlib.decompress(value).decode('utf-8', errors='replace')
+
+
+def add_missing_columns(cursor, table, columns):
+    """
+    Add the columns a table doesn't have yet
+    :param columns: column definitions, like 'duration REAL'
+    """
+    existing = [row[1] for row in cursor.execute('PRAGMA table_info(' + table + ');')]
+    for column in columns:
+        if column.split()[0] not in existing:
+            cursor.execute('ALTER TABLE ' + table + ' ADD COLUMN ' + column + ';')
+
+
+def create_probe_tables(cursor):
+    """
+    Version 1: the probe tables. Databases from before the schema was versioned may have them already
+    """
+    cursor.execute('CREATE TABLE IF NOT EXISTS probes(id INTEGER, type TEXT, name TEXT, create_time INTEGER, '
+                   'start_time INTEGER, end_time INTEGER, PRIMARY KEY(id ASC));')
+    cursor.execute('CREATE TABLE IF NOT EXISTS probe_inputs(probe_id INTEGER, name TEXT, value TEXT);')
+    cursor.execute('CREATE TABLE IF NOT EXISTS probe_outputs(probe_id INTEGER, errors TEXT, output TEXT);')
+    add_missing_columns(cursor, 'probe_outputs', ['error_size INTEGER', 'output_size INTEGER'])
+
+
+def add_runs(cursor):
+    """
+    Version 2: the runs probes belong to, each probe's repo, status and duration, and indexes for looking up
+    a probe's inputs and outputs and for the filters of query_probes
+    """
+    cursor.execute('CREATE TABLE runs(id INTEGER, repo TEXT, before_commit TEXT, after_commit TEXT, '
+                   'webhook_time INTEGER, PRIMARY KEY(id ASC));')
+    add_missing_columns(cursor, 'probes', ['run_id INTEGER', 'repo TEXT', 'status TEXT', 'duration REAL'])
+    cursor.execute('CREATE INDEX probe_inputs_probe_id ON probe_inputs(probe_id);')
+    cursor.execute('CREATE INDEX probe_outputs_probe_id ON probe_outputs(probe_id);')
+    cursor.execute('CREATE INDEX probes_run_id ON probes(run_id);')
+    cursor.execute('CREATE INDEX probes_repo ON probes(repo, id);')
+    cursor.execute('CREATE INDEX probes_type ON probes(type, id);')
+    cursor.execute('CREATE INDEX probes_status ON probes(status, id);')
+    cursor.execute('CREATE INDEX probes_create_time ON probes(create_time);')
+    cursor.execute('CREATE INDEX runs_repo ON runs(repo, id);')
+
+
+def add_compression(cursor):
+    """
+    Version 3: how each probe's errors and output are compressed, NULL if they aren't
+    """
+    add_missing_columns(cursor, 'probe_outputs', ['compression TEXT'])
+
+
+def add_blobs(cursor):
+    """
+    Version 4: errors and outputs stored once per content in blobs, which probe_outputs refer to by hash.
+    Older rows keep theirs inline
+    """
+    cursor.execute('CREATE TABLE blobs(hash TEXT, data BLOB, compression TEXT, size INTEGER, PRIMARY KEY(hash));')
+    add_missing_columns(cursor, 'probe_outputs', ['errors_hash TEXT', 'output_hash TEXT'])
+    cursor.execute('CREATE INDEX probe_outputs_errors_hash ON probe_outputs(errors_hash);')
+    cursor.execute('CREATE INDEX probe_outputs_output_hash ON probe_outputs(output_hash);')
+
+
+# Schema migrations in order. Migration n brings a database from user_version n - 1 to n
+MIGRATIONS = [create_probe_tables, add_runs, add_compression, add_blobs]
+
+
+def enable_incremental_vacuum(db):
+    """
+    Turn on incremental vacuum, so the compactor can give deleted history's space back.
+    A database that already has tables is rewritten once for it, which locks it for as long as that takes
+    """
+    if db.execute('PRAGMA auto_vacuum;').fetchone()[0] == 2:
+        return
+    empty = db.execute('PRAGMA page_count;').fetchone()[0] == 0
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+    if empty:
+        # Takes effect when the first table is created
+        return
+    logging.warning("Enabling incremental vacuum on the probe database, which rewrites it once")
+    try:
+        db.execute('VACUUM;')
+    except sqlite3.OperationalError as e:
+        logging.warning("Couldn't rewrite the probe database for incremental vacuum: %s", e)
+
+
+def migrate_database(db):
+    """
+    Apply the migrations a database is missing, each in its own transaction.
+    New databases are created with incremental vacuum, while existing ones are only rewritten for it once the
+    compactor first runs
+    """
+    if db.execute('PRAGMA page_count;').fetchone()[0] == 0:
+        enable_incremental_vacuum(db)
+    for version, migration in enumerate(MIGRATIONS, 1):
+        cursor = db.cursor()
+        cursor.execute('BEGIN IMMEDIATE;')
+        try:
+            # Read in the transaction, so servers starting at the same time don't both migrate
+            if cursor.execute('PRAGMA user_version;').fetchone()[0] >= version:
+                db.rollback()
+                continue
+            print("Migrating probe database to version " + str(version))
+            migration(cursor)
+            cursor.execute('PRAGMA user_version = ' + str(version) + ';')
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+
+
+def query_probes(db, repo=None, module=None, status=None, since=None, until=None, before=None,
+                 limit=DEFAULT_PAGE_SIZE, outputs=True):
+    """
+    Get a page of probe records, newest first. Pages are found by probe id (keyset pagination) rather than
+    with an offset, so they take as long to get however much history there is
+    :param module: only get probes of this module type
+    :param since: only get probes created at or after this Unix time...
+    :param until: ...and before this one
+    :param before: only get probes with lower ids, to get the page after one whose next was before
+    :param outputs: include the errors and output, and not just their hashes
+    :return: (records as dicts, next) where next is the before of the next page, or None if this is the last one
+    """
+    conditions = []
+    params = []
+    for condition, value in (('p.repo = ?', repo), ('p.type = ?', module), ('p.status = ?', status),
+                             ('p.create_time >= ?', since), ('p.create_time < ?', until), ('p.id < ?', before)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    query = 'SELECT p.id, p.run_id, p.repo, p.type, p.name, p.status, p.create_time, p.start_time, p.end_time, ' \
+            'p.duration, r.before_commit, r.after_commit, o.error_size, o.output_size, o.errors_hash, o.output_hash'
+    if outputs:
+        query += ', ' + STORED_OUTPUT_COLUMNS
+    query += ' FROM probes p LEFT JOIN runs r ON r.id = p.run_id LEFT JOIN probe_outputs o ON o.probe_id = p.id'
+    if outputs:
+        query += BLOB_JOINS
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    # One extra row tells whether there is a next page
+    query += ' ORDER BY p.id DESC LIMIT ?;'
+    cursor = db.execute(query, params + [limit + 1])
+    columns = ['id', 'run_id', 'repo', 'type', 'name', 'status', 'create_time', 'start_time', 'end_time', 'duration',
+               'before_commit', 'after_commit', 'error_size', 'output_size', 'errors_hash', 'output_hash']
+    records = []
+    for row in cursor:
+        record = {column: text(value) for column, value in zip(columns, row)}
+        if outputs:
+            errors, errors_compression, output, output_compression = row[len(columns):]
+            record['errors'] = decompress(errors, errors_compression)
+            record['output'] = decompress(output, output_compression)
+        records.append(record)
+    next_page = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_page = records[-1]['id']
+    by_id = {}
+    for record in records:
+        record['inputs'] = {}
+        by_id[record['id']] = record
+    if by_id:
+        ids = list(by_id)
+        for probe_id, name, value in db.execute('SELECT probe_id, name, value FROM probe_inputs WHERE probe_id IN ('
+                                                + ', '.join('?' * len(ids)) + ');', ids):
+            by_id[probe_id]['inputs'][name] = text(value)
+    return records, next_page
+
+
+def iterate_probes(db, before=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Get a page of probes with their inputs and outputs, newest first. Uses one query, and yields each probe
+    as soon as its rows are read, so the whole page is never in memory at once
+    :param before: only get probes with lower ids, to get the page after one ending with that id
+    :return: an iterator of (probe, inputs, output) with the probe's row of probes, its inputs as (name, value)
+    pairs and its (errors, output, error_size, output_size)
+    """
+    query = 'SELECT p.*, ' + STORED_OUTPUT_COLUMNS + ', o.error_size, o.output_size, i.name, i.value ' \
+            'FROM (SELECT * FROM probes'
+    params = []
+    if before is not None:
+        query += ' WHERE id < ?'
+        params.append(before)
+    query += ' ORDER BY id DESC LIMIT ?) p LEFT JOIN probe_outputs o ON o.probe_id = p.id' + BLOB_JOINS + \
+             ' LEFT JOIN probe_inputs i ON i.probe_id = p.id ORDER BY p.id DESC, i.rowid;'
+    cursor = db.execute(query, params + [limit])
+    # The columns of probes come first, then the output's six and the input's two
+    probe_columns = len(cursor.description) - 8
+    current = None
+    for row in cursor:
+        if current is None or current[0][0] != row[0]:
+            if current is not None:
+                yield current
+            errors, errors_compression, output, output_compression, error_size, output_size = \
+                row[probe_columns:probe_columns + 6]
+            current = (row[:probe_columns], [], (decompress(errors, errors_compression),
+                                                 decompress(output, output_compression), error_size, output_size))
+        if row[-2] is not None:
+            current[1].append((row[-2], text(row[-1])))
+    if current is not None:
+        yield current
+
+
+def read_blob(db, content_hash):
+    """
+    Get the errors or output stored under a hash, as given by query_probes
+    :return: the text, or None if there is no such blob
+    """
+    row = db.execute('SELECT data, compression FROM blobs WHERE hash = ?;', (content_hash,)).fetchone()
+    if row is None:
+        return None
+    return decompress(*row)
+
+
+def text(value):
+    """
+    Older rows can hold output as bytes, which JSON can't represent
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return value
+
+
+class ProbeLogger:
+    """
+    Writes probe records to the probe database from a background thread
+    """
+    def __init__(self, path, flush_interval=DEFAULT_LOG_FLUSH_INTERVAL, batch_size=DEFAULT_LOG_BATCH_SIZE):
+        """
+        :param path: the database file, whose tables init_database has created
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = None
+        self.closed = False
+        # Set by configure()
+        self.compression = 'zlib'
+        self.max_age = None
+        self.max_rows_per_module = None
+        self.max_size = None
+        self.compact_interval = DEFAULT_COMPACT_INTERVAL
+        self.compactor = None
+        self.stopping = threading.Event()
+        atexit.register(self.close)
+
+    def configure(self, compression='zlib', max_age=None, max_rows_per_module=None, max_size=None,
+                  compact_interval=DEFAULT_COMPACT_INTERVAL):
+        """
+        Set how probe history is stored and how much of it is kept, and start the compactor if any of it is to be
+        deleted
+        :param compression: 'zlib', 'zstd' or 'none'
+        :param max_age: days probes are kept for
+        :param max_rows_per_module: most probes kept of each module type
+        :param max_size: MB the database can use before the oldest probes are deleted
+        :param compact_interval: seconds between runs of the compactor
+        """
+        compression = compression.lower()
+        if compression not in ('zlib', 'zstd', 'none'):
+            raise ValueError("Unknown probe log compression " + compression)
+        if compression == 'zstd' and zstandard is None:
+            logging.warning("The zstandard package isn't installed, compressing probe output with zlib instead")
+            compression = 'zlib'
+        self.lock.acquire()
+        self.compression = None if compression == 'none' else compression
+        self.max_age = max_age
+        self.max_rows_per_module = max_rows_per_module
+        self.max_size = max_size * 1024 * 1024 if max_size is not None else None
+        self.compact_interval = compact_interval
+        retention = (max_age, max_rows_per_module, max_size)
+        if self.compactor is None and not self.closed and retention != (None, None, None):
+            self.compactor = threading.Thread(target=self.__compact_loop__, name="probe-log-compactor", daemon=True)
+            self.compactor.start()
+        self.lock.release()
+
+    def compact(self):
+        """
+        Delete the probes the retention settings don't keep, oldest first, then give free pages back to the
+        file system with an incremental vacuum. The first time, the database may have to be rewritten for that
+        :return: the number of probes deleted
+        """
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            enable_incremental_vacuum(db)
+            deleted = 0
+            if self.max_age is not None:
+                cutoff = int(time.time() - self.max_age * 24 * 3600)
+                deleted += self.__delete__(db, 'SELECT id FROM probes WHERE create_time < ? ORDER BY id LIMIT ?;',
+                                           (cutoff,))
+            if self.max_rows_per_module is not None:
+                for (module,) in db.execute('SELECT DISTINCT type FROM probes;').fetchall():
+                    # The newest probe that is over the limit
+                    row = db.execute('SELECT id FROM probes WHERE type = ? ORDER BY id DESC LIMIT 1 OFFSET ?;',
+                                     (module, self.max_rows_per_module)).fetchone()
+                    if row is not None:
+                        deleted += self.__delete__(db, 'SELECT id FROM probes WHERE type = ? AND id <= ? LIMIT ?;',
+                                                   (module, row[0]))
+            if self.max_size is not None:
+                while self.__used_size__(db) > self.max_size:
+                    removed = self.__delete__(db, 'SELECT id FROM probes ORDER BY id LIMIT ?;', (), once=True)
+                    if removed == 0:
+                        break
+                    deleted += removed
+            if deleted:
+                db.execute('DELETE FROM runs WHERE id NOT IN (SELECT run_id FROM probes WHERE run_id IS NOT NULL);')
+                db.commit()
+                logging.info("Deleted %d probes from the probe log", deleted)
+            # Each step frees one page, and executescript steps the pragma until it is done, unlike execute
+            db.executescript('PRAGMA incremental_vacuum;')
+            return deleted
+        finally:
+            db.close()
+
+    def __delete__(self, db, select, params, once=False):
+        """
+        Delete the probes found by select, with their inputs and outputs, a batch per transaction. Blobs are
+        deleted with the last output that refers to them
+        :param select: query for the ids of the probes to delete, ending with a LIMIT parameter
+        :param once: only delete one batch
+        :return: the number of probes deleted
+        """
+        deleted = 0
+        while True:
+            ids = [row[0] for row in db.execute(select, params + (COMPACT_BATCH_SIZE,))]
+            if not ids:
+                break
+            placeholders = ', '.join('?' * len(ids))
+            hashes = set()
+            for row in db.execute('SELECT errors_hash, output_hash FROM probe_outputs WHERE probe_id IN ('
+                                  + placeholders + ');', ids):
+                hashes.update(content_hash for content_hash in row if content_hash is not None)
+            db.execute('DELETE FROM probe_inputs WHERE probe_id IN (' + placeholders + ');', ids)
+            db.execute('DELETE FROM probe_outputs WHERE probe_id IN (' + placeholders + ');', ids)
+            db.execute('DELETE FROM probes WHERE id IN (' + placeholders + ');', ids)
+            db.executemany('DELETE FROM blobs WHERE hash = ? '
+                           'AND NOT EXISTS (SELECT 1 FROM probe_outputs WHERE errors_hash = ?) '
+                           'AND NOT EXISTS (SELECT 1 FROM probe_outputs WHERE output_hash = ?);',
+                           [(content_hash,) * 3 for content_hash in hashes])
+            db.commit()
+            deleted += len(ids)
+            if once:
+                break
+        return deleted
+
+    def __used_size__(self, db):
+        """
+        Get the bytes of the database that hold data, not counting free pages
+        """
+        page_count = db.execute('PRAGMA page_count;').fetchone()[0]
+        free_pages = db.execute('PRAGMA freelist_count;').fetchone()[0]
+        return (page_count - free_pages) * db.execute('PRAGMA page_size;').fetchone()[0]
+
+    def __missing_blobs__(self, db, hashes):
+        """
+        :return: the hashes that have no blob yet
+        """
+        hashes = list(hashes)
+        stored = set()
+        for start in range(0, len(hashes), COMPACT_BATCH_SIZE):
+            chunk = hashes[start:start + COMPACT_BATCH_SIZE]
+            stored.update(row[0] for row in db.execute('SELECT hash FROM blobs WHERE hash IN ('
+                                                       + ', '.join('?' * len(chunk)) + ');', chunk))
+        return [content_hash for content_hash in hashes if content_hash not in stored]
+
+    def __compact_loop__(self):
+        while not self.stopping.wait(self.compact_interval):
+            try:
+                self.compact()
+            except sqlite3.Error:
+                logging.exception("Failed to compact the probe log %s", self.path)
+
+    def log(self, record):
+        """
+        Queue a probe's record to be written
+        :param record: a dict with the probe's type, name, run_id, repo, status, create_time, start_time, end_time,
+        duration, inputs as a list of (name, value) pairs, errors, output, error_size and output_size
+        """
+        self.lock.acquire()
+        if self.closed:
+            self.lock.release()
+            logging.warning("Probe log is closed, not recording %s probe", record['type'])
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__write_loop__, name="probe-logger", daemon=True)
+            self.thread.start()
+        self.queue.put(record)
+        self.lock.release()
+
+    def log_run(self, repo, before_commit, after_commit, webhook_time):
+        """
+        Record a run right away, since the records of its probes refer to its id
+        :return: the run's id, or None if it couldn't be recorded
+        """
+        try:
+            db = sqlite3.connect(self.path, timeout=30)
+            try:
+                cursor = db.execute('INSERT INTO runs (repo, before_commit, after_commit, webhook_time) '
+                                    'VALUES (?, ?, ?, ?);', (repo, before_commit, after_commit, webhook_time))
+                db.commit()
+                return cursor.lastrowid
+            finally:
+                db.close()
+        except sqlite3.Error:
+            logging.exception("Failed to record a run of %s in %s", repo, self.path)
+            return None
+
+    def flush(self):
+        """
+        Block until every record queued so far is written
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Write the queued records and stop the writer thread
+        """
+        self.lock.acquire()
+        self.closed = True
+        self.stopping.set()
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+        self.lock.release()
+        if thread is not None:
+            thread.join()
+
+    def __connect__(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute('PRAGMA journal_mode=WAL;')
+            # WAL stays consistent without syncing every commit, only the last commits can be lost on power failure
+            db.execute('PRAGMA synchronous=NORMAL;')
+        except sqlite3.Error:
+            db.close()
+            raise
+        return db
+
+    def __write_loop__(self):
+        # Connected with the first batch, and again with the next one if that fails, so the queue is always
+        # drained and flush() can't block forever
+        db = None
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            if record is None:
+                self.queue.task_done()
+                break
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    self.queue.task_done()
+                    break
+                batch.append(record)
+            try:
+                if db is None:
+                    db = self.__connect__()
+                self.__write__(db, batch)
+            except Exception:
+                logging.exception("Failed to record %d probes in %s", len(batch), self.path)
+            for _ in batch:
+                self.queue.task_done()
+        if db is not None:
+            db.close()
+
+    def __write__(self, db, batch):
+        """
+        Insert a batch of records in one transaction
+        """
+        # Errors and outputs by hash. Only the ones that aren't stored yet are compressed and written
+        contents = {}
+        hashes = []
+        for record in batch:
+            errors_hash, errors = blob_content(record['errors'])
+            output_hash, output = blob_content(record['output'])
+            hashes.append((errors_hash, output_hash))
+            for content_hash, content in ((errors_hash, errors), (output_hash, output)):
+                if content_hash is not None:
+                    contents[content_hash] = content
+        # Compressed before taking the write lock, so readers and the compactor aren't kept waiting
+        compressed = {content_hash: compress(contents[content_hash], self.compression)
+                      for content_hash in self.__missing_blobs__(db, contents)}
+        cursor = db.cursor()
+        # Taking the write lock first, so the ids handed out below can't be taken by another connection
+        cursor.execute('BEGIN IMMEDIATE;')
+        try:
+            blobs = []
+            # Checked again, since the compactor can have deleted blobs in the meantime
+            for content_hash in self.__missing_blobs__(db, contents):
+                if content_hash not in compressed:
+                    compressed[content_hash] = compress(contents[content_hash], self.compression)
+                data, compression = compressed[content_hash]
+                blobs.append((content_hash, data, compression, len(contents[content_hash])))
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM probes;')
+            next_id = cursor.fetchone()[0] + 1
+            probes, inputs, outputs = [], [], []
+            for probe_id, record, (errors_hash, output_hash) in zip(itertools.count(next_id), batch, hashes):
+                probes.append((probe_id, record['type'], record['name'], record['run_id'], record['repo'],
+                               record['status'], record['create_time'], record['start_time'], record['end_time'],
+                               record['duration']))
+                inputs += [(probe_id, name, value) for name, value in record['inputs']]
+                outputs.append((probe_id, record['error_size'], record['output_size'], errors_hash, output_hash))
+            cursor.executemany('INSERT INTO blobs (hash, data, compression, size) VALUES (?, ?, ?, ?);', blobs)
+            cursor.executemany('INSERT INTO probes (id, type, name, run_id, repo, status, create_time, start_time, '
+                               'end_time, duration) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);', probes)
+            cursor.executemany('INSERT INTO probe_inputs VALUES (?, ?, ?);', inputs)
+            cursor.executemany('INSERT INTO probe_outputs (probe_id, error_size, output_size, errors_hash, '
+                               'output_hash) VALUES (?, ?, ?, ?, ?);', outputs)
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
@@ -1,14 +1,22 @@
-import json
-import subprocess
 import sys
 
-target_file = sys.argv[1]
-target = sys.argv[2]
-threshold = float(sys.argv[3])
+from radon.complexity import cc_visit
 
-output = json.loads(subprocess.check_output(['radon', 'cc', '-a', '-s', '-j', target_file]))[target_file]
 
-for field in output:
-    if field['name'] == target:
-        print(int(field['complexity']) > threshold)
-        quit()
+def main(path, target, threshold):
+    """
+    Check whether the cyclomatic complexity of a function or class in path is above threshold.
+    Used directly by the checkComplexity module
+    :return: "True" or "False" on a line, as the script prints it, or nothing if target isn't found
+    """
+    with open(path, 'r') as target_file:
+        blocks = cc_visit(target_file.read())
+
+    for block in blocks:
+        if block.name == target:
+            return str(int(block.complexity) > float(threshold)) + '\n'
+    return ''
+
+
+if __name__ == '__main__':
+    print(main(sys.argv[1], sys.argv[2], sys.argv[3]), end="")
@@ -1,7 +1,13 @@
 import filecmp
 import sys
 
-if len(sys.argv) > 2:
-    old = sys.argv[1]
-    cur = sys.argv[2]
-    print(not filecmp.cmp(old, cur), end="")
+
+def main(old, cur):
+    """
+    Check whether two files differ. Used directly by the fileChange module
+    """
+    return not filecmp.cmp(old, cur)
+
+
+if __name__ == '__main__' and len(sys.argv) > 2:
+    print(main(sys.argv[1], sys.argv[2]), end="")
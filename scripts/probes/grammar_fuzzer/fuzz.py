@@ -1,53 +1,62 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
 import subprocess
+import sys
 from collections import namedtuple
 
-import antlr_fuzzer
-
-arg_parser = argparse.ArgumentParser(description='Run ANTLR grammar fuzzer')
+# The fuzzer's own imports are relative to this folder, which isn't on the path when this file is
+# imported as scripts.probes.grammar_fuzzer.fuzz (e.g. by the worker pool)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-arg_parser.add_argument('grammar_file', type=str, help='ANTLR grammar file to be used for fuzzing')
-arg_parser.add_argument('entry_rule', type=str, help='ANTLR rule to use as initial rule')
-arg_parser.add_argument('fuzz_command', type=str, help='command to run with generated input as STDIN')
+import antlr_fuzzer
 
-arg_parser.add_argument('--iterations', type=str, default=100, help='number of iterations')
-arg_parser.add_argument('--max_depth', type=str, default=500, help='max depth in grammar to generate')
+FuzzError = namedtuple('FuzzError', ['stdin', 'stdout', 'stderr', 'returncode'])
 
-args = arg_parser.parse_args()
 
-FuzzError = namedtuple('FuzzError', ['stdin', 'stdout', 'stderr', 'returncode'])
+def main(grammar_file, entry_rule, fuzz_command, iterations=100, max_depth=500):
+    """
+    Run fuzz_command once per input generated from the grammar. Used directly by the grammarFuzz module
+    :return: a report of every input that made fuzz_command exit with a nonzero status code
+    """
+    fuzz_errors = []
+    report = []
 
-fuzz_errors = []
+    for fuzz_input in antlr_fuzzer.generate(grammar_file, entry_rule, int(iterations), int(max_depth)):
+        p = subprocess.Popen(fuzz_command, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate(input=fuzz_input.encode())
 
-for fuzz_input in antlr_fuzzer.generate(args.grammar_file, args.entry_rule, args.iterations, args.max_depth):
-    p = subprocess.Popen(args.fuzz_command, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate(input=fuzz_input.encode())
+        if p.returncode != 0:
+            fuzz_errors.append(FuzzError(fuzz_input, stdout.decode('utf-8'), stderr.decode('utf-8'), p.returncode))
+            report.append('ERROR Command exited with nonzero status code ' + str(p.returncode))
 
-    if p.returncode != 0:
-        fuzz_errors.append(FuzzError(fuzz_input, stdout.decode('utf-8'), stderr.decode('utf-8'), p.returncode))
-        print('ERROR Command exited with nonzero status code', p.returncode)
+            report.append('STDIN:')
+            report.append(fuzz_input)
+            report.append('STDOUT:')
+            report.append(stdout.decode('utf-8'))
+            report.append('STDERR:')
+            report.append(stderr.decode('utf-8'))
 
-        print('STDIN:')
-        print(fuzz_input)
-        print('STDOUT:')
-        print(stdout.decode('utf-8'))
-        print('STDERR:')
-        print(stderr.decode('utf-8'))
+            report.append('')
+            report.append('')
 
-        print()
-        print()
+    if not report:
+        return ''
+    return '\n'.join(report) + '\n'
 
-# print(fuzz_errors)
 
-# p = subprocess.Popen(['rev'], stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Run ANTLR grammar fuzzer')
 
-# stdout_data = p.communicate(input='data_to_write'.encode())[0]
+    arg_parser.add_argument('grammar_file', type=str, help='ANTLR grammar file to be used for fuzzing')
+    arg_parser.add_argument('entry_rule', type=str, help='ANTLR rule to use as initial rule')
+    arg_parser.add_argument('fuzz_command', type=str, help='command to run with generated input as STDIN')
 
-# print(stdout_data)
+    arg_parser.add_argument('--iterations', type=int, default=100, help='number of iterations')
+    arg_parser.add_argument('--max_depth', type=int, default=500, help='max depth in grammar to generate')
 
-# stdout_data = p.communicate(input='data_to_write'.encode())[0]
+    args = arg_parser.parse_args()
 
-# print(stdout_data)
+    print(main(args.grammar_file, args.entry_rule, args.fuzz_command, args.iterations, args.max_depth), end='')
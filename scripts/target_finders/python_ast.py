@@ -92,19 +92,24 @@ def visit_node(node, location):
     return None
 
 
-if __name__ == '__main__' and len(sys.argv) > 2:
-    file_path = sys.argv[1]
-    ast_path = sys.argv[2]
-
-    with open(file_path, 'rb') as src_stream:
+def main(file, astLocation):
+    """
+    Find the location of a class or function in a Python file. Used directly by the pythonAST module
+    :return: the file path, start and end of the node on separate lines, or "None" if it isn't found,
+    as the script prints them
+    """
+    with open(file, 'rb') as src_stream:
         source = src_stream.read()
-        atok = asttokens.ASTTokens(source, parse=True)
-        location = parse_ast_location(ast_path)
-        node = visit_node(atok.tree, location)
-
-        if node:
-            print(file_path)
-            print(':'.join(map(str, node.first_token.start)))
-            print(':'.join(map(str, node.last_token.end)))
-        else:
-            print(None)
+    atok = asttokens.ASTTokens(source, parse=True)
+    location = parse_ast_location(astLocation)
+    node = visit_node(atok.tree, location)
+
+    if node:
+        return '\n'.join([file,
+                          ':'.join(map(str, node.first_token.start)),
+                          ':'.join(map(str, node.last_token.end))]) + '\n'
+    return 'None\n'
+
+
+if __name__ == '__main__' and len(sys.argv) > 2:
+    print(main(sys.argv[1], sys.argv[2]), end="")
@@ -0,0 +1,160 @@
+"""
+Stress test for running many repos' probes at the same time. Creates local git repos, loads their configs
+and runs all of their probes concurrently, then checks that every probe ran in the saad/ directory and
+read its own repo's checkout, and that probes skipped by their paths filter skip their dependents too.
+Usage: python3 stress_test.py [--repos 20] [--files 5] [--engine threads]
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import core
+
+root_path = os.path.dirname(os.path.abspath(__file__))
+
+
+def git(args, cwd):
+    subprocess.check_call(['git', '-c', 'user.name=saad', '-c', 'user.email=saad@localhost'] + args, cwd=cwd,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_repo(path, name, files, results):
+    """
+    Create a repo with two commits, whose probe files each write their results to a file in the results folder.
+    Each file also has a probe whose paths didn't change, and a probe depending on it that mustn't run
+    """
+    os.makedirs(os.path.join(path, "probes"))
+    git(['init', '--quiet', '.'], path)
+    with open(os.path.join(path, "saad.cfg"), 'w') as config:
+        config.write("[Local]\n    ProbeFolders = probes\n")
+    with open(os.path.join(path, "name.txt"), 'w') as file:
+        file.write("old")
+    git(['add', '-A'], path)
+    git(['commit', '--quiet', '-m', 'First commit'], path)
+
+    with open(os.path.join(path, "name.txt"), 'w') as file:
+        file.write(name)
+    for i in range(files):
+        probes = [
+            {"name": "cwd", "type": "stressWorkingDirectory", "config": {}},
+            {"name": "head", "type": "stressHeadName", "config": {}},
+            {"name": "name", "type": "readFile", "config": {"path": "{HEAD}/name.txt"}},
+            {"type": "stressRecord", "config": {
+                "line": " ".join([name, str(i), "{cwd}", "{head}", "{name}", "{HEAD:name.txt}"]),
+                "results": os.path.join(results, name + "-" + str(i))
+            }},
+            {"name": "untouched", "type": "stressHeadName", "paths": ["untouched/*"], "config": {}},
+            {"type": "stressRecord", "config": {
+                "line": "{untouched}",
+                "results": os.path.join(results, "skipped-" + name + "-" + str(i))
+            }}
+        ]
+        with open(os.path.join(path, "probes", "probe" + str(i) + ".json"), 'w') as file:
+            json.dump(probes, file)
+    git(['add', '-A'], path)
+    git(['commit', '--quiet', '-m', 'Second commit'], path)
+
+
+def run_repo(url, name, engine, runs, errors):
+    try:
+        repo = core.Repo(url, name, root_path)
+        repo.config['configfiles'] = "saad.cfg"
+        repo.config['probeengine'] = engine
+        repo.load_config_recursive("", 'current', True)
+        runs.append((repo, repo.run_all_probes('current', 'HEAD~1')))
+    except Exception as e:
+        logging.exception("Running %s failed", name)
+        errors.append(name + ": " + str(e))
+
+
+def check_results(results, repos, files):
+    """
+    :return: a list of problems with the results
+    """
+    expected_cwd = os.path.realpath(root_path)
+    problems = []
+    seen = set()
+    lines = []
+    for result in os.listdir(results):
+        if result.startswith("skipped-"):
+            problems.append("Probe depending on a skipped probe ran: " + result)
+            continue
+        with open(os.path.join(results, result)) as file:
+            lines.append(file.read())
+    for line in lines:
+        # Probe outputs end with newlines, so split on any whitespace
+        fields = line.split()
+        if len(fields) != 6:
+            problems.append("Malformed result: " + line)
+            continue
+        name, i, cwd, head, read, blob = fields
+        seen.add((name, i))
+        if cwd != expected_cwd:
+            problems.append("{} probe {} ran in {} instead of {}".format(name, i, cwd, expected_cwd))
+        for found in (head, read, blob):
+            if found != name:
+                problems.append("{} probe {} read {}'s checkout".format(name, i, found))
+    for repo in range(repos):
+        for i in range(files):
+            if ("repo" + str(repo), str(i)) not in seen:
+                problems.append("repo{} probe {} didn't run".format(repo, i))
+    if len(lines) != len(seen):
+        problems.append("{} results for {} probe files".format(len(lines), len(seen)))
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run many repos\' probes at once and check where they ran')
+    parser.add_argument('--repos', type=int, default=20, help='number of repos')
+    parser.add_argument('--files', type=int, default=5, help='number of probe files per repo')
+    parser.add_argument('--engine', default='threads', help='probe engine (threads or asyncio)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    core.modules['stressWorkingDirectory'] = core.Module('stressWorkingDirectory', {"command": "sleep 0.1; pwd -P"})
+    core.modules['stressHeadName'] = core.Module('stressHeadName', {"command": "cd {HEAD} && cat name.txt"})
+    core.modules['stressRecord'] = core.Module('stressRecord', {"command": "printf '%s' {line} > {results}",
+                                                                "sideEffects": True})
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results = os.path.join(temp_dir, "results")
+        os.mkdir(results)
+        urls = {}
+        for repo in range(args.repos):
+            name = "repo" + str(repo)
+            make_repo(os.path.join(temp_dir, name), name, args.files, results)
+            urls[name] = "file://" + os.path.join(temp_dir, name)
+
+        start = time.time()
+        runs = []
+        errors = []
+        threads = [threading.Thread(target=run_repo, args=(url, name, args.engine, runs, errors))
+                   for name, url in urls.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for _, run in runs:
+            run.wait()
+        print("Ran {} repos with {} probe files each in {:.2f} seconds".format(args.repos, args.files,
+                                                                             time.time() - start))
+
+        problems = errors + check_results(results, args.repos, args.files)
+        for repo, _ in runs:
+            for probe in repo.get_all_probes():
+                problems.append("{} {} probe still {}".format(repo.name, probe.headers['type'],
+                                                              probe.headers['status']))
+        core.shutdown_schedulers()
+
+    for problem in problems:
+        print(problem)
+    if problems:
+        print("FAILED: {} problems".format(len(problems)))
+        sys.exit(1)
+    print("OK")
@@ -1,5 +1,6 @@
 import logging
 import os
+import subprocess
 import tempfile
 import time
 from distutils.dir_util import copy_tree
@@ -10,22 +11,20 @@ logging.basicConfig(level=logging.DEBUG)
 
 root_path = os.path.dirname(os.path.abspath(__file__))
 
-with tempfile.TemporaryDirectory() as previous_dirname:
-    with tempfile.TemporaryDirectory() as current_dirname:
-        print("Copying current directory (as current commit)...")
-        copy_tree(root_path, current_dirname)
+# Guarded so worker processes, which re-import the main module, don't run the probes again
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as previous_dirname:
+        with tempfile.TemporaryDirectory() as current_dirname:
+            print("Copying current directory (as current commit)...")
+            copy_tree(root_path, current_dirname)
 
-        print("Copy current directory and resetting to HEAD (as previous commit)...")
-        copy_tree(root_path, previous_dirname)
-        os.chdir(previous_dirname)
-        os.system("git reset --hard HEAD")
+            print("Copy current directory and resetting to HEAD (as previous commit)...")
+            copy_tree(root_path, previous_dirname)
+            subprocess.call(["git", "reset", "--hard", "HEAD"], cwd=previous_dirname)
 
-        os.chdir(root_path)
+            print("Running probes...")
+            start = time.time()
+            core.iterate_over_configs(current_dirname, previous_dirname).wait()
 
-        print("Running probes...")
-        start = time.time()
-        core.iterate_over_configs(current_dirname, previous_dirname)
-        # core.iterate_over_configs_parallel(current_dirname, previous_dirname)
-
-        print("Probes finished")
-        print("Took " + str(time.time() - start) + " seconds to run all probes")
+            print("Probes finished")
+            print("Took " + str(time.time() - start) + " seconds to run all probes")
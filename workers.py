@@ -0,0 +1,240 @@
+"""
+Running callable modules, either in the server process or on a pool of long-lived worker processes.
+Kept separate from core so worker processes can import it without loading the server.
+"""
+import importlib
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+
+import psutil
+
+DEFAULT_WORKER_PROCESSES = os.cpu_count() or 4
+# Workers are replaced after running this many jobs...
+DEFAULT_WORKER_MAX_JOBS = 100
+# ...or once their memory use goes over this many MB
+DEFAULT_WORKER_MAX_MEMORY = 512
+
+# Imported once by the fork server, so workers start with the heavy libraries already loaded.
+# Modules that aren't installed are skipped
+PRELOAD_MODULES = [
+    'workers',
+    'asttokens',
+    'radon.complexity',
+    'antlr4',
+    'scripts.target_finders.python_ast',
+    'scripts.probes.complexity',
+    'scripts.probes.grammar_fuzzer.fuzz',
+]
+
+# Functions used by callable modules, by "package.module:function" path
+callables = {}
+callables_lock = threading.Lock()
+
+
+def load_callable(path):
+    """
+    Import the function a callable module points at, e.g. "scripts.probes.filechange:main".
+    Modules are only imported once, so later calls skip the import cost
+    """
+    callables_lock.acquire()
+    try:
+        if path not in callables:
+            module_name, function_name = path.split(":", 1)
+            callables[path] = getattr(importlib.import_module(module_name), function_name)
+        return callables[path]
+    finally:
+        callables_lock.release()
+
+
+def accepted_kwargs(function, kwargs):
+    """
+    Drop the keyword arguments function doesn't take, like probe inputs that are only there to wait for another
+    probe ("waitFor": "{a}"), which a command would ignore too
+    """
+    parameters = inspect.signature(function).parameters.values()
+    if any(parameter.kind == inspect.Parameter.VAR_KEYWORD for parameter in parameters):
+        return kwargs
+    names = {parameter.name for parameter in parameters
+             if parameter.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY)}
+    return {name: value for name, value in kwargs.items() if name in names}
+
+
+def format_result(result):
+    """
+    Turn the value returned by a callable module into probe output.
+    Strings are used as is, other values are formatted like the scripts print them, lists and dicts as JSON
+    """
+    if result is None:
+        return ''
+    if isinstance(result, str):
+        return result
+    if isinstance(result, (bool, int, float)):
+        return str(result)
+    return json.dumps(result)
+
+
+def call_module(path, kwargs):
+    """
+    Call a callable module with the given keyword arguments
+    :return: (output, errors) as bytes, like a finished subprocess
+    """
+    try:
+        function = load_callable(path)
+        result = function(**accepted_kwargs(function, kwargs))
+    except Exception:
+        return b'', traceback.format_exc().encode('utf-8')
+    return format_result(result).encode('utf-8'), b''
+
+
+def worker_main(conn, cwd):
+    """
+    Loop run by each worker process: receive (path, kwargs) jobs, send back (output, errors, memory in bytes)
+    """
+    os.chdir(cwd)
+    process = psutil.Process()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        path, kwargs = job
+        output, error = call_module(path, kwargs)
+        conn.send((output, error, process.memory_info().rss))
+
+
+class Worker:
+    """
+    A single worker process and the pipe used to send it jobs
+    """
+    def __init__(self, context, cwd):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn, cwd), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.memory = 0
+
+    def call(self, path, kwargs, timeout=None):
+        """
+        Run a job on this worker
+        :return: (output, errors, timed_out). The worker is killed if it times out
+        """
+        self.jobs += 1
+        try:
+            self.conn.send((path, kwargs))
+            if timeout is not None and timeout > 0 and not self.conn.poll(timeout):
+                self.kill()
+                return b'', b'', True
+            output, error, self.memory = self.conn.recv()
+            return output, error, False
+        except (EOFError, OSError):
+            self.process.join(1)
+            return b'', ("Worker process exited with code " + str(self.process.exitcode)).encode('utf-8'), False
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def kill(self):
+        """
+        Kill the worker and anything it started
+        """
+        try:
+            for child in psutil.Process(self.process.pid).children(recursive=True):
+                child.kill()
+        except psutil.NoSuchProcess:
+            pass
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        """
+        Ask the worker to exit once it's idle
+        """
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+
+
+class WorkerPool:
+    """
+    Pool of pre-forked worker processes for callable modules. Gives crashy or CPU heavy Python probes
+    their own process without paying the interpreter startup and import cost every time
+    """
+    def __init__(self, size=DEFAULT_WORKER_PROCESSES, max_jobs=DEFAULT_WORKER_MAX_JOBS,
+                 max_memory=DEFAULT_WORKER_MAX_MEMORY, cwd=None, preload=PRELOAD_MODULES):
+        """
+        :param max_memory: memory limit per worker in MB
+        :param cwd: working directory of the workers, defaults to the current one
+        """
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory * 1024 * 1024
+        self.cwd = cwd or os.getcwd()
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context('forkserver')
+            self.context.set_forkserver_preload(list(preload))
+        else:
+            self.context = multiprocessing.get_context('spawn')
+        self.closed = False
+        # Holds a Worker, or None for a slot whose worker hasn't been started yet
+        self.idle = queue.Queue()
+        for _ in range(max(1, int(size))):
+            self.idle.put(None)
+        self.size = max(1, int(size))
+        pools.append(self)
+
+    def call(self, path, kwargs, timeout=None):
+        """
+        Call a callable module on the next free worker, waiting for one if they are all busy
+        :return: (output, errors, timed_out)
+        """
+        if self.closed:
+            raise RuntimeError("Worker pool has been shut down")
+        worker = self.idle.get()
+        try:
+            if worker is None or not worker.is_alive():
+                worker = Worker(self.context, self.cwd)
+            output, error, timed_out = worker.call(path, kwargs, timeout)
+            if not worker.is_alive():
+                worker = None
+            elif worker.jobs >= self.max_jobs or worker.memory > self.max_memory:
+                logging.debug("Recycling worker %d after %d jobs (%d bytes)", worker.process.pid, worker.jobs,
+                              worker.memory)
+                worker.stop()
+                worker = None
+            return output, error, timed_out
+        finally:
+            self.idle.put(worker)
+
+    def shutdown(self):
+        """
+        Stop every worker, waiting for the ones that are busy
+        """
+        self.closed = True
+        for _ in range(self.size):
+            worker = self.idle.get()
+            if worker is not None:
+                worker.stop()
+
+
+# Every pool that has been created, so they can all be shut down together
+pools = []
+
+
+def shutdown_pools():
+    for pool in list(pools):
+        pool.shutdown()